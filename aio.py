@@ -0,0 +1,60 @@
+#######################
+# AI Assistant Python Framework
+# Date: 2024-01-25
+#######################
+
+__all__ = ['PIAAsyncRunner']
+
+from concurrent.futures import Future
+from typing import Awaitable, Callable
+import asyncio
+import contextlib
+import threading
+
+class PIAAsyncRunner:
+    """PIA Async Runner
+    Runs coroutines on a background event loop thread, so the (threaded) dispatcher
+    can keep hundreds of completions in flight from one process.
+    - submit: Schedule a coroutine, returns a concurrent.futures.Future.
+    - limit: Async context manager bounding the in-flight requests (global and per model).
+    - call: Await a request under limit() with the per-request timeout.
+    - throttle: Optional async (model, kwargs) -> None, awaited by call() before
+      limit() and the timeout, e.g. to wait for rate limits.
+    """
+    def __init__(self, max_concurrency: int = 100, model_concurrency: dict = {}, timeout: float = 60,
+        throttle: Callable = None):
+        self.max_concurrency = max_concurrency
+        self.model_concurrency = dict(model_concurrency)
+        self.timeout = timeout
+        self.throttle = throttle
+        self._sem = None
+        self._model_sem = {}
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self._thread.start()
+
+    def submit(self, coro: Awaitable) -> Future:
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    @contextlib.asynccontextmanager
+    async def limit(self, model: str):
+        # Semaphores are only touched from the loop thread, no lock is needed.
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.max_concurrency)
+        msem = self._model_sem.get(model)
+        if msem is None and model in self.model_concurrency:
+            msem = self._model_sem.setdefault(model, asyncio.Semaphore(self.model_concurrency[model]))
+        # Take the model slot first, so a saturated model does not hold global slots.
+        if msem is None:
+            async with self._sem:
+                yield
+        else:
+            async with msem:
+                async with self._sem:
+                    yield
+
+    async def call(self, model: str, func: Callable, /, *args, **kwargs):
+        if self.throttle is not None:
+            await self.throttle(model, kwargs)
+        async with self.limit(model):
+            return await asyncio.wait_for(func(*args, **kwargs), self.timeout)
@@ -4,18 +4,343 @@
 #######################
 
 from config import c
-from openai import OpenAI, AzureOpenAI
+from classes import EndpointConfig, OpenAIConfig, RateLimitConfig
+from openai import OpenAI, AzureOpenAI, AsyncOpenAI, AsyncAzureOpenAI
+from openai import APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+from contextvars import ContextVar
+from types import SimpleNamespace
+from typing import Dict
+from tokens import estimate_tokens
+import asyncio
+import random
+import threading
+import time
 
-ai: OpenAI = None
+# Failures which say nothing about the request itself, they are retried on another endpoint.
+RETRYABLE = (APIConnectionError, APITimeoutError, InternalServerError, RateLimitError)
 
-if c.openai.api_type == 'openai':
-    ai = OpenAI(
-        api_key = c.openai.api_key,
-        base_url = c.openai.api_base
+# The predicted total tokens of the next request of the current conversation (0: unknown).
+# main_exec sets it from the usage stored with the previous reply.
+expected_tokens: ContextVar = ContextVar('expected_tokens', default = 0)
+
+class PIATokenBucket:
+    """A token bucket refilled with capacity units per minute.
+    take() reserves units even if the bucket runs dry (the level goes negative)
+    and returns how long the caller has to wait, so callers are served in order.
+    """
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.rate = capacity / 60
+        self.level = float(capacity)
+        self.time = time.monotonic()
+
+    def take(self, n: float) -> float:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.time) * self.rate)
+        self.time = now
+        self.level -= min(n, self.capacity)
+        return max(-self.level / self.rate, 0)
+
+    def give(self, n: float):
+        self.level = min(self.capacity, self.level + n)
+
+class PIARateLimiter:
+    """PIA Rate Limiter
+    Client-side RPM/TPM quotas per model (OpenAIConfig.rate_limits).
+    A request reserves one request and its predicted tokens, then sleeps until the
+    buckets cover them; nothing is rejected. The prediction is expected_tokens when
+    set, else an estimate of the prompt plus max_tokens. Once the usage is known,
+    settle() gives back (or takes) the difference.
+    """
+    def __init__(self, limits: Dict[str, RateLimitConfig]):
+        self.buckets = {}
+        for model, limit in limits.items():
+            self.buckets[model] = (
+                PIATokenBucket(limit.rpm) if limit.rpm > 0 else None,
+                PIATokenBucket(limit.tpm) if limit.tpm > 0 else None
+            )
+        self.waited = 0.0
+        self.queued = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def cost(kwargs: dict) -> int:
+        expected = expected_tokens.get()
+        if expected > 0:
+            return expected
+        prompt = 0
+        for m in kwargs.get('messages', []):
+            content = m.get('content') if isinstance(m, dict) else getattr(m, 'content', None)
+            prompt += estimate_tokens(content if isinstance(content, str) else str(content or ''))
+        return prompt + (kwargs.get('max_tokens') or 0)
+
+    def reserve(self, model: str, cost: int) -> float:
+        rpm, tpm = self.buckets.get(model, (None, None))
+        wait = 0.0
+        with self._lock:
+            if rpm is not None:
+                wait = max(wait, rpm.take(1))
+            if tpm is not None:
+                wait = max(wait, tpm.take(cost))
+            if wait > 0:
+                self.queued += 1
+                self.waited += wait
+        return wait
+
+    def wait(self, model: str, cost: int):
+        wait = self.reserve(model, cost)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def wait_async(self, model: str, cost: int):
+        wait = self.reserve(model, cost)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def settle(self, model: str, cost: int, comp):
+        tpm = self.buckets.get(model, (None, None))[1]
+        usage = getattr(comp, 'usage', None)
+        if tpm is None or usage is None:
+            return
+        with self._lock:
+            tpm.give(cost - usage.total_tokens)
+
+    def stats(self) -> dict:
+        return {
+            'queued': self.queued,
+            'waited': self.waited,
+            'models': {m: {'rpm': b[0] and b[0].level, 'tpm': b[1] and b[1].level} for m, b in self.buckets.items()},
+        }
+
+class PIAEndpoint:
+    """One backend endpoint with its sync and async clients and its health counters."""
+    def __init__(self, config: EndpointConfig, max_retries: int = 2):
+        self.name = config.name or config.azure_endpoint or config.api_base
+        self.weight = max(config.weight, 1e-6)
+        if config.api_type == 'azure':
+            kwargs = dict(api_key = config.api_key, api_version = config.api_version,
+                azure_endpoint = config.azure_endpoint, max_retries = max_retries)
+            self.client = AzureOpenAI(**kwargs)
+            self.aclient = AsyncAzureOpenAI(**kwargs)
+        else:
+            kwargs = dict(api_key = config.api_key, base_url = config.api_base, max_retries = max_retries)
+            self.client = OpenAI(**kwargs)
+            self.aclient = AsyncOpenAI(**kwargs)
+        self.outstanding = 0
+        self.failures = 0
+        self.open_until = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.latency = 0.0
+
+    def stats(self) -> dict:
+        return {
+            'weight': self.weight,
+            'healthy': self.open_until <= time.monotonic(),
+            'outstanding': self.outstanding,
+            'requests': self.requests,
+            'errors': self.errors,
+            'latency_ms': self.latency * 1000,
+        }
+
+class PIAClientPool:
+    """PIA Client Pool
+    Spreads completions over several endpoints.
+    - Balancing: the healthy endpoint with the fewest outstanding requests per weight.
+    - Circuit breaker: an endpoint is skipped for breaker_cooldown seconds after
+      breaker_errors failures in a row, or right away on a 429 (Retry-After is honoured).
+    - Failover: connection errors, timeouts, 5xx and 429 are retried on another
+      endpoint, up to retries times. Other errors are raised as is.
+    - Rate limits: create() waits for the PIARateLimiter before it is sent.
+      acreate() leaves that to the caller (see throttle), so the async runner can
+      queue requests without holding its concurrency slots or eating its timeout.
+    - Streams (stream=True) hold their endpoint until the last chunk, then settle with
+      the usage of the final chunk. A stream which fails before its first chunk is
+      retried elsewhere, after that the error is counted and raised.
+    - stats: Health, outstanding requests, errors and average latency per endpoint.
+    """
+    def __init__(self, endpoints: list, retries: int = 2, breaker_errors: int = 3, breaker_cooldown: float = 30,
+        limiter: PIARateLimiter = None):
+        self.endpoints = endpoints
+        self.retries = retries
+        self.breaker_errors = breaker_errors
+        self.breaker_cooldown = breaker_cooldown
+        self.limiter = limiter or PIARateLimiter({})
+        self._lock = threading.Lock()
+
+    def _acquire(self, tried: list) -> PIAEndpoint:
+        now = time.monotonic()
+        with self._lock:
+            candidates = [e for e in self.endpoints if e not in tried] or self.endpoints
+            healthy = [e for e in candidates if e.open_until <= now]
+            if len(healthy) > 0:
+                best = min((e.outstanding + 1) / e.weight for e in healthy)
+                ep = random.choice([e for e in healthy if (e.outstanding + 1) / e.weight == best])
+            else:
+                # Everything is open, probe the endpoint which recovers first (half-open).
+                ep = min(candidates, key = lambda e: e.open_until)
+            ep.outstanding += 1
+            ep.requests += 1
+        return ep
+
+    def _release(self, ep: PIAEndpoint, start: float, error: Exception = None):
+        with self._lock:
+            ep.outstanding -= 1
+            if error is None:
+                # Moving average of the latency, weighted towards recent requests.
+                elapsed = time.monotonic() - start
+                ep.latency = elapsed if ep.latency == 0 else ep.latency * 0.9 + elapsed * 0.1
+                ep.failures = 0
+                return
+            ep.errors += 1
+            ep.failures += 1
+            if isinstance(error, RateLimitError):
+                ep.open_until = time.monotonic() + self._retry_after(error)
+            elif ep.failures >= self.breaker_errors:
+                ep.open_until = time.monotonic() + self.breaker_cooldown
+
+    def _retry_after(self, error: RateLimitError) -> float:
+        try:
+            return float(error.response.headers.get('retry-after'))
+        except Exception:
+            return self.breaker_cooldown
+
+    async def throttle(self, model: str, kwargs: dict):
+        await self.limiter.wait_async(model, self.limiter.cost(kwargs))
+
+    def create(self, **kwargs):
+        model = kwargs.get('model')
+        cost = self.limiter.cost(kwargs)
+        self.limiter.wait(model, cost)
+        if kwargs.get('stream'):
+            return self._stream(model, cost, kwargs)
+        comp = self._create(**kwargs)
+        self.limiter.settle(model, cost, comp)
+        return comp
+
+    async def acreate(self, **kwargs):
+        if kwargs.get('stream'):
+            return self._astream(kwargs.get('model'), self.limiter.cost(kwargs), kwargs)
+        comp = await self._acreate(**kwargs)
+        self.limiter.settle(kwargs.get('model'), self.limiter.cost(kwargs), comp)
+        return comp
+
+    def _create(self, **kwargs):
+        tried = []
+        for n in range(self.retries + 1):
+            ep = self._acquire(tried)
+            tried.append(ep)
+            start = time.monotonic()
+            try:
+                comp = ep.client.chat.completions.create(**kwargs)
+            except RETRYABLE as e:
+                self._release(ep, start, e)
+                if n == self.retries:
+                    raise
+                continue
+            except Exception:
+                self._release(ep, start)
+                raise
+            self._release(ep, start)
+            return comp
+
+    async def _acreate(self, **kwargs):
+        tried = []
+        for n in range(self.retries + 1):
+            ep = self._acquire(tried)
+            tried.append(ep)
+            start = time.monotonic()
+            try:
+                comp = await ep.aclient.chat.completions.create(**kwargs)
+            except RETRYABLE as e:
+                self._release(ep, start, e)
+                if n == self.retries:
+                    raise
+                continue
+            except Exception:
+                self._release(ep, start)
+                raise
+            self._release(ep, start)
+            return comp
+
+    def _stream(self, model: str, cost: int, kwargs: dict):
+        tried = []
+        for n in range(self.retries + 1):
+            ep = self._acquire(tried)
+            tried.append(ep)
+            start = time.monotonic()
+            started = False
+            usage = None
+            try:
+                for chunk in ep.client.chat.completions.create(**kwargs):
+                    started = True
+                    usage = getattr(chunk, 'usage', None) or usage
+                    yield chunk
+            except RETRYABLE as e:
+                self._release(ep, start, e)
+                if started or n == self.retries:
+                    raise
+                continue
+            except BaseException:
+                # Other errors, or the caller stopped reading (GeneratorExit).
+                self._release(ep, start)
+                raise
+            self._release(ep, start)
+            self.limiter.settle(model, cost, SimpleNamespace(usage = usage))
+            return
+
+    async def _astream(self, model: str, cost: int, kwargs: dict):
+        tried = []
+        for n in range(self.retries + 1):
+            ep = self._acquire(tried)
+            tried.append(ep)
+            start = time.monotonic()
+            started = False
+            usage = None
+            try:
+                async for chunk in await ep.aclient.chat.completions.create(**kwargs):
+                    started = True
+                    usage = getattr(chunk, 'usage', None) or usage
+                    yield chunk
+            except RETRYABLE as e:
+                self._release(ep, start, e)
+                if started or n == self.retries:
+                    raise
+                continue
+            except BaseException:
+                self._release(ep, start)
+                raise
+            self._release(ep, start)
+            self.limiter.settle(model, cost, SimpleNamespace(usage = usage))
+            return
+
+    def stats(self) -> dict:
+        return {
+            'endpoints': {e.name: e.stats() for e in self.endpoints},
+            'limiter': self.limiter.stats(),
+        }
+
+def open_pool(config: OpenAIConfig) -> PIAClientPool:
+    """Build the client pool from OpenAIConfig.endpoints, or from its single endpoint fields."""
+    endpoints = config.endpoints or [EndpointConfig(
+        api_key = config.api_key,
+        api_base = config.api_base,
+        api_type = config.api_type,
+        api_version = config.api_version,
+        azure_endpoint = config.azure_endpoint
+    )]
+    # With several endpoints the pool retries elsewhere, the SDK should not retry the same one.
+    max_retries = 2 if len(endpoints) == 1 else 0
+    return PIAClientPool(
+        [PIAEndpoint(e, max_retries) for e in endpoints],
+        retries = config.retries if len(endpoints) > 1 else 0,
+        breaker_errors = config.breaker_errors,
+        breaker_cooldown = config.breaker_cooldown,
+        limiter = PIARateLimiter(config.rate_limits)
     )
-elif c.openai.api_type == 'azure':
-    ai = AzureOpenAI(
-        api_key = c.openai.api_key,
-        api_version = c.openai.api_version,
-        azure_endpoint = c.openai.azure_endpoint
-    )
\ No newline at end of file
+
+pool: PIAClientPool = open_pool(c.openai)
+
+# ai/aai keep the interface of the OpenAI clients: ai.chat.completions.create(...)
+ai = SimpleNamespace(chat = SimpleNamespace(completions = SimpleNamespace(create = pool.create)))
+aai = SimpleNamespace(chat = SimpleNamespace(completions = SimpleNamespace(create = pool.acreate)))
@@ -0,0 +1,58 @@
+#######################
+# AI Assistant Python Framework
+# Date: 2024-01-25
+#######################
+
+__all__ = ['PIABlobStore']
+
+from typing import Union
+import hashlib
+import mmap
+import os
+import tempfile
+
+class PIABlobStore:
+    """PIA Blob Store
+    Content-addressed storage for the binary content of messages (images, files, audio).
+    A blob is a file named by the SHA-256 of its bytes under root/<2 hex>/<hex>,
+    so the same content is stored once and a blob never changes after it is written.
+    Messages only keep the digest, get() maps the file and returns a read-only
+    memoryview, nothing is copied into the process until it is read.
+    Files are written to a temporary name and renamed, so any process may put and get.
+    - put: Store bytes, returns the digest.
+    - get: A read-only memoryview of a blob.
+    - path: The file of a blob.
+    """
+    def __init__(self, root: str = 'blobs'):
+        self.root = root
+
+    def path(self, digest: str) -> str:
+        if len(digest) != 64 or not all(c in '0123456789abcdef' for c in digest):
+            raise ValueError('Invalid blob digest: {}'.format(digest))
+        return os.path.join(self.root, digest[:2], digest[2:])
+
+    def exists(self, digest: str) -> bool:
+        return os.path.exists(self.path(digest))
+
+    def put(self, data: Union[bytes, memoryview]) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if os.path.exists(path):
+            return digest
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        fd, tmp = tempfile.mkstemp(dir = os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        return digest
+
+    def get(self, digest: str) -> memoryview:
+        with open(self.path(digest), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return memoryview(b'')
+            # The mapping stays valid after the file is closed, it lives as long as the view.
+            return memoryview(mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ))
@@ -0,0 +1,125 @@
+#######################
+# AI Assistant Python Framework
+# Date: 2024-01-25
+#######################
+
+__all__ = ['PIALRUCache', 'PIAResponseCache', 'MISS']
+
+from collections import OrderedDict
+import hashlib
+import json
+import threading
+import time
+
+MISS = object()
+
+class PIALRUCache:
+    """PIA LRU Cache
+    A bounded, thread-safe LRU cache whose entries expire after ttl seconds.
+    get() returns MISS when the key is absent or expired.
+    Hits and misses are counted, see stats().
+    """
+    def __init__(self, max_entries: int = 1024, ttl: float = 60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[0] < time.monotonic():
+                del self._data[key]
+                item = None
+            if item is None:
+                self.misses += 1
+                return MISS
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, value, ttl: float = None):
+        expire = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expire, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total > 0 else 0.0,
+            'entries': len(self._data),
+        }
+
+class PIAResponseCache:
+    """PIA Response Cache
+    Caches completion replies by prompt, so duplicate prompts (e.g. the same question
+    from many users) are answered without calling the backend.
+    A PIALRUCache in front of the storage (get_cached/put_cached) keeps hot entries
+    in memory; entries live ttl seconds and at most max_entries are stored.
+    - key: Hash a prompt into a cache key.
+    - get: The cached reply, or MISS.
+    - put: Store a reply.
+    - stats: Hits, misses and hit rate (front and storage hits together).
+    """
+    def __init__(self, storage, ttl: float = 3600, max_entries: int = 10000, front_entries: int = 1024):
+        self.storage = storage
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.front = PIALRUCache(front_entries, ttl)
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(*parts) -> str:
+        data = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def get(self, key: str):
+        reply = self.front.get(key)
+        if reply is MISS:
+            now = int(time.time()*1000)
+            item = self.storage.get_cached(key, now)
+            if item is not None:
+                reply = item[0]
+                self.front.put(key, reply, (item[1] - now) / 1000)
+        with self._lock:
+            if reply is MISS:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return reply
+
+    def put(self, key: str, reply: str):
+        now = int(time.time()*1000)
+        self.front.put(key, reply)
+        self.storage.put_cached(key, reply, now + int(self.ttl * 1000))
+        with self._lock:
+            self._puts += 1
+            evict = self._puts % 100 == 0
+        if evict:
+            self.storage.evict_cached(now, self.max_entries)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total > 0 else 0.0,
+            'front': self.front.stats(),
+        }
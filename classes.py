@@ -6,20 +6,46 @@
 __all__ = ['BaseConfig']
 
 from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional, Callable, ClassVar, Literal
+from typing import Any, Dict, List, Optional, Callable, ClassVar, Literal, Iterable, Mapping, Union
+from types import MappingProxyType
 from multiprocess import Process
 import multiprocess as PIAProcess
+from cache import PIALRUCache
+from blobs import PIABlobStore
+import concurrent.futures
+import threading
+import traceback
+import copy
+import os
 
 class BaseConfig(BaseModel):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
+class EndpointConfig(BaseConfig):
+    name: str = ''
+    api_key: str = '<None>'
+    api_base: str = 'https://api.openai.com/v1'
+    api_type: Literal['openai', 'azure'] = 'openai'
+    api_version: str = ''
+    azure_endpoint: str = ''
+    weight: float = 1.0
+
+class RateLimitConfig(BaseConfig):
+    rpm: int = 0
+    tpm: int = 0
+
 class OpenAIConfig(BaseConfig):
     api_key: str = '<None>'
     api_base: str = 'https://api.openai.com/v1'
     api_type: Literal['openai', 'azure'] = 'openai'
     api_version: str = ''
     azure_endpoint: str = ''
+    endpoints: List[EndpointConfig] = []
+    retries: int = 2
+    breaker_errors: int = 3
+    breaker_cooldown: float = 30
+    rate_limits: Dict[str, RateLimitConfig] = {}
     
 class ContextConfig(BaseConfig):
     model: str = 'gpt-4'
@@ -33,13 +59,45 @@ class ContextConfig(BaseConfig):
     system_prompt: str = ''
     error_format: str = '{}'
     stream: bool = False
+    stream_chunk: int = 32
+    stable_prefix: bool = False
+    tool_filter: dict = {}
+    response_cache: bool = False
+    response_cache_ttl: float = 3600
+    response_cache_size: int = 10000
+    summary_model: str = ''
+    summary_max_tokens: int = 500
+    summary_prompt: str = '请把下面的对话压缩成一段简洁的摘要, 保留人物、事实、约定和未完成的事项。如果有之前的摘要, 把它合并进新的摘要。'
     
 class LoopConfig(BaseConfig):
     db_path: str = 'wx_secret.db'
+    storage: Literal['sqlite', 'memory'] = 'sqlite'
+    db_cache_kb: int = 16384
     memory: int = 10
+    memory_tokens: int = 0
+    model_memory_tokens: dict = {}
+    summary_interval: float = 0
+    summary_min_rows: int = 20
+    summary_max_rows: int = 200
     max_wait_time: int = 10
     interval: int = 3
     max_workers: int = 10
+    send_workers: int = 4
+    tool_workers: int = 8
+    tool_timeout: float = 30
+    flush_window: float = 0.05
+    flush_size: int = 64
+    use_async: bool = False
+    max_concurrency: int = 100
+    model_concurrency: dict = {}
+    request_timeout: float = 60
+    event_driven: bool = True
+    send_retry_max: float = 300
+    priority_listeners: dict = {}
+    priority_uids: dict = {}
+    fair_penalty: float = 10
+    fair_half_life: float = 300
+    blob_path: str = 'blobs'
 
 class Configure(BaseConfig):
     openai: OpenAIConfig = OpenAIConfig()
@@ -56,7 +114,8 @@ class PIAMessage(BaseModel):
     - timestamp: The timestamp of the message.
     - type: The type of the message. 
     (0: text, 1: image, 2: video, 3: audio, 4: file, 5: location, 6: contact, 7: event, 8: system, 9: command, 10: other)
-    - content: The content of the message. (bytes)
+    - content: The content of the message. (bytes, or a read-only memoryview of a blob)
+    - blob: The digest of the content in the blob store (PIABlobStore).
     - is_human: Is this message sent by human?
     - is_ai: Is this message sent by AI?
     - tokens_all: The number of tokens used in the message.
@@ -65,19 +124,21 @@ class PIAMessage(BaseModel):
     """
     uid: str = Field(None, alias='uid', pattern=r'^[a-zA-Z0-9_]+$')
     uname: str = Field(None, alias='uname', min_length=1, max_length=100)
-    text: str = Field(None, alias='text', min_length=1, max_length=1000)
+    text: Optional[str] = Field(None, alias='text', min_length=1, max_length=1000)
     timestamp: int = Field(None, alias='timestamp', ge=0)
     type: int = Field(None, alias='type', ge=0, le=10)
-    content: bytes = Field(None, alias='content')
+    content: Optional[Union[memoryview, bytes]] = Field(None, alias='content')
     is_human: bool = Field(False, alias='is_human')
     is_ai: bool = Field(True, alias='is_ai')
     tool_call: bool = Field(False, alias='tool_call')
     tokens_all: int = Field(None, alias='tokens_all', ge=0)
     tokens_prompt: int = Field(None, alias='tokens_prompt', ge=0)
     extension: str = ''
+    blob: Optional[str] = Field(None, alias='blob')
+    model_config = ConfigDict(arbitrary_types_allowed=True)
     
     def __str__(self) -> str:
-        return 'PIAMessage({}/{}, {})'.format(self.uname, self.uid, str(len(self.text)) + ' bytes')
+        return 'PIAMessage({}/{}, {})'.format(self.uname, self.uid, str(len(self.text or self.content or '')) + ' bytes')
     
 class PIARequest(BaseModel):
     uid: str = Field(None, alias='uid', pattern=r'^[a-zA-Z0-9_]+$')
@@ -86,17 +147,91 @@ class PIARequest(BaseModel):
     
 class PIAResponseMessage(BaseModel):
     uname: str = Field(None, alias='uname', min_length=1, max_length=100)
-    text: str = Field(None, alias='text', min_length=1, max_length=1000)
+    text: Optional[str] = Field(None, alias='text', min_length=1, max_length=1000)
     timestamp: int = Field(None, alias='timestamp', ge=0)
     type: int = Field(None, alias='type', ge=0, le=10)
-    content: bytes = Field(None, alias='content')
-    pass
+    content: Optional[Union[memoryview, bytes]] = Field(None, alias='content')
+    blob: Optional[str] = Field(None, alias='blob')
+    model_config = ConfigDict(arbitrary_types_allowed=True)
 
 class PIAResponse(BaseModel):
     t_uid: str = Field(None, alias='t_uid', pattern=r'^[a-zA-Z0-9_]+$')
     t_uname: str = Field(None, alias='t_uname', min_length=1, max_length=100)
     messages: List[PIAResponseMessage] = Field(None, alias='messages')
 
+class PIACachePolicy(BaseModel):
+    """PIA Cache Policy
+    Tells PIA-Core how it may memoize the results of a registered function.
+    - idempotent: The result only depends on the arguments, results are cached only if True.
+    - ttl: Seconds a cached result stays valid.
+    - max_entries: The maximum number of cached results of this function.
+    """
+    idempotent: bool = False
+    ttl: float = 60
+    max_entries: int = 1024
+
+class PIAToolRegistry:
+    """PIA Tool Registry
+    Keeps every function registered by the loaded modules.
+    PIAModule.register and PIAModule.handler update it, and the OpenAI-format tool
+    list is only rebuilt after such a change, so main_exec never copies schemas.
+    - tools: The tool list (a tuple, do not modify it), optionally filtered by function names.
+    - table: Function name -> registered function (with its handler and policies).
+    - cache: The result cache of a function registered with an idempotent PIACachePolicy.
+    - stats: Hit/miss counters of every result cache.
+    """
+    internal_keys = ('handler', 'parallel', 'timeout', 'cache')
+
+    def __init__(self):
+        self._functions = {}
+        self._tools = None
+        self._selected = {}
+        self._caches = {}
+        self._lock = threading.Lock()
+
+    def update(self, name: str, function: dict):
+        with self._lock:
+            self._functions[name] = function
+            self._tools = None
+            self._selected = {}
+            policy = function.get('cache')
+            if policy is not None and policy.idempotent:
+                if name not in self._caches:
+                    self._caches[name] = PIALRUCache(policy.max_entries, policy.ttl)
+            else:
+                self._caches.pop(name, None)
+
+    def cache(self, name: str) -> Optional[PIALRUCache]:
+        return self._caches.get(name)
+
+    def stats(self) -> dict:
+        return {name: c.stats() for name, c in self._caches.items()}
+
+    def table(self) -> Mapping[str, dict]:
+        return MappingProxyType(self._functions)
+
+    def tools(self, names: Optional[Iterable[str]] = None) -> tuple:
+        tools = self._tools
+        if tools is None:
+            with self._lock:
+                tools = tuple(
+                    {
+                        'type' : 'function',
+                        'function' : {k: copy.deepcopy(v) for k, v in j.items() if k not in self.internal_keys}
+                    } for j in self._functions.values()
+                )
+                self._tools = tools
+        if names is None:
+            return tools
+        key = frozenset(names)
+        selected = self._selected.get(key)
+        if selected is None:
+            selected = tuple(t for t in tools if t['function']['name'] in key)
+            self._selected[key] = selected
+        return selected
+
+tool_registry = PIAToolRegistry()
+
 class PIAModule(BaseModel):
     """PIA Module
     You can use this class to create your own PIA modules.
@@ -111,6 +246,7 @@ class PIAModule(BaseModel):
     PIA-Core will start up a single process to run this method. 
     - callback: Callback function
     You can use this method to send a response to PIA-Core actively.
+    blob_path is the blob store of the loaded config (LoopConfig.blob_path), set by PIA-Core before run.
     """
     m_name: str
     author: str
@@ -120,6 +256,7 @@ class PIAModule(BaseModel):
     mainloop_args: list = []
     i_callback:Callable = lambda *args, **kwargs: None
     ps: list = []
+    blob_path: str = 'blobs'
     def __init__(self, 
         m_name = '',
         author = '',
@@ -141,6 +278,9 @@ class PIAModule(BaseModel):
         function_name,
         function_description,
         function_parameters = {},
+        parallel = True,
+        timeout = None,
+        cache = None,
     ):
         """Register a function to PIA-Core
 
@@ -148,6 +288,9 @@ class PIAModule(BaseModel):
             function_name (str): The name of the function.
             function_description (str): When and how to use this function.
             function_parameters (dict, optional): The parameters to use your function, read the docs of openai to get more details. Defaults to {}.
+            parallel (bool, optional): May run at the same time as the other tool calls of the same turn. Defaults to True.
+            timeout (float, optional): Seconds to wait for the handler, None means LoopConfig.tool_timeout. Defaults to None.
+            cache (PIACachePolicy, optional): Memoize results by arguments, only for idempotent functions. Defaults to None.
 
         Returns:
             bool: True if success, False if failed.
@@ -162,8 +305,12 @@ class PIAModule(BaseModel):
         self.function_lists[function_name] = {
             'name': function_name,
             'description': function_description,
-            'parameters': function_parameters
+            'parameters': function_parameters,
+            'parallel': parallel,
+            'timeout': timeout,
+            'cache': cache
         }
+        tool_registry.update(function_name, self.function_lists[function_name])
         return True
     
     def handler(self, func_list:list, *args, **kwargs):
@@ -173,6 +320,7 @@ class PIAModule(BaseModel):
         def wrapper(func):
             for i in func_list:
                 self.function_lists[i]['handler'] = func
+                tool_registry.update(i, self.function_lists[i])
             return func
         return wrapper
     
@@ -219,18 +367,39 @@ class PIAModule(BaseModel):
         self.i_callback = callback
         
 class PIAListener(BaseModel):
+    """PIA Listener
+    A frontend which receives messages (call) and delivers replies (sender/streamer).
+    With sender(channel=True) the sender and streamer always run inside the listener
+    process: run() creates a delivery channel (a pipe shared with the main loop
+    process) and a thread in the listener process which calls them, while
+    i_sender/i_streamer of every other process write the PIAResponse to the channel
+    and wait for the result of the real function, which comes back on a second pipe
+    (False after ack_timeout seconds). Replies are posted by one process, the main loop.
+    Listeners can then keep their connections in plain process-local state.
+    Blob content is not pickled, the listener process maps it again from blob_path.
+    """
     m_name: str
     author: str
     version: str = '0.0.1'
     uuid: str = ''
     i_callback:Callable = lambda *args, **kwargs: None
     i_sender:Callable = lambda *args, **kwargs: None
+    i_streamer:Optional[Callable] = None
     i_mainloop:Callable = lambda *args, **kwargs: None
     keep_alive: bool = True
     mainloop_args: list = []
     i_mainloop_args: list = []
     i_mainloop_kwargs: dict = {}
     ps: list = []
+    use_channel: bool = False
+    i_channel: Any = None
+    i_acks: Any = None
+    i_waiting: dict = {}
+    i_posted: int = 0
+    i_ack_pid: int = 0
+    i_ack_lock: ClassVar = threading.Lock()
+    ack_timeout: float = 30
+    blob_path: str = 'blobs'
     def __init__(self, 
         uuid,
         m_name = '',
@@ -252,12 +421,31 @@ class PIAListener(BaseModel):
     def call(self, message: PIAMessage, *args, **kwargs):
         return self.i_callback(message, self, *args, **kwargs)
     
-    def sender(self, *args, **kwargs):
+    def sender(self, channel = False, *args, **kwargs):
+        """Register the sender (decorator)
+        The function is called as func(response: PIAResponse) and returns True once delivered.
+        With channel=True it runs in the listener process, see PIAListener.
+        """
         def wrapper(func):
             self.i_sender = func
+            self.use_channel = channel
             return func
         return wrapper
     
+    def streamer(self, *args, **kwargs):
+        """Register a stream sender (decorator)
+        The function is called as func(response: PIAResponse, final: bool) while a reply is generated,
+        once per text chunk, then once with final=True and no messages.
+        Only used when ContextConfig.stream is enabled.
+        """
+        def wrapper(func):
+            self.i_streamer = func
+            return func
+        return wrapper
+    
+    def can_stream(self) -> bool:
+        return self.i_streamer is not None
+    
     def mainloop_keepalive(self, *args, **kwargs):
         while True:
             self.i_mainloop(*args, **kwargs)
@@ -287,6 +475,65 @@ class PIAListener(BaseModel):
     def set_args(self, args:list):
         self.mainloop_args = args
         
+    def post(self, response: PIAResponse, final = None):
+        """Write a response to the delivery channel and return the result of the listener process
+        (used as i_sender/i_streamer outside the listener process).
+        """
+        messages = []
+        for m in response.messages or []:
+            if m.blob is not None:
+                m = m.model_copy(update={'content': None})
+            elif isinstance(m.content, memoryview):
+                m = m.model_copy(update={'content': bytes(m.content)})
+            messages.append(m)
+        f = concurrent.futures.Future()
+        with self.i_ack_lock:
+            if self.i_ack_pid != os.getpid():
+                self.i_ack_pid = os.getpid()
+                self.i_waiting = {}
+                threading.Thread(target=self.collect, daemon=True).start()
+            self.i_posted += 1
+            seq = self.i_posted
+            self.i_waiting[seq] = f
+        self.i_channel.put((seq, response.model_copy(update={'messages': messages}), final))
+        try:
+            return f.result(timeout = self.ack_timeout)
+        except concurrent.futures.TimeoutError:
+            with self.i_ack_lock:
+                self.i_waiting.pop(seq, None)
+            return False
+
+    def collect(self):
+        """Resolve posted responses with the results sent back by the listener process."""
+        while True:
+            seq, st = self.i_acks.get()
+            with self.i_ack_lock:
+                f = self.i_waiting.pop(seq, None)
+            if f is not None:
+                f.set_result(st)
+
+    def deliver(self):
+        """Serve the delivery channel, runs in a thread of the listener process."""
+        blobs = PIABlobStore(self.blob_path)
+        while True:
+            seq, response, final = self.i_channel.get()
+            st = False
+            try:
+                for m in response.messages or []:
+                    if m.blob is not None and m.content is None:
+                        m.content = blobs.get(m.blob)
+                if final is None:
+                    st = self.i_sender(response)
+                else:
+                    st = self.i_streamer(response, final)
+            except Exception:
+                traceback.print_exc()
+            self.i_acks.put((seq, st == True))
+
+    def serve(self, *args):
+        threading.Thread(target=self.deliver, daemon=True).start()
+        return self.i_mainloop(*args)
+
     def run(self):
         p_args = ()
         if self.i_mainloop.__code__.co_argcount == 1:
@@ -297,9 +544,20 @@ class PIAListener(BaseModel):
             p_args = (self.mainloop_args, self.i_mainloop_args, self.i_mainloop_kwargs)
         else:
             raise PIAError('Too many arguments in mainloop function.{}'.format(self))
-        ps = Process(target=self.i_mainloop, args=p_args)
+        if not self.use_channel:
+            ps = Process(target=self.i_mainloop, args=p_args)
+            self.ps.append(ps)
+            ps.start()
+            return ps
+        self.i_channel = PIAProcess.SimpleQueue()
+        self.i_acks = PIAProcess.SimpleQueue()
+        ps = Process(target=self.serve, args=p_args)
         self.ps.append(ps)
         ps.start()
+        # The listener process keeps the real functions, every process forked from here posts.
+        self.i_sender = self.post
+        if self.i_streamer is not None:
+            self.i_streamer = self.post
         return ps
     
     def stop(self):
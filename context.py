@@ -0,0 +1,182 @@
+#######################
+# AI Assistant Python Framework
+# Date: 2024-01-25
+#######################
+
+__all__ = ['PIAContextBuilder', 'PIACompactor']
+
+from classes import PIAMessage
+from collections import OrderedDict, deque
+from typing import Callable
+import threading
+import time
+import traceback
+
+class PIAContextBuilder:
+    """PIA Context Builder
+    Renders the transcript of a conversation incrementally.
+    The rendered line and the PIAMessage of every row are cached per UID, so a call
+    only renders the rows that are new since the previous call and drops the rows
+    that left the window. The transcript of an unchanged window is returned as is,
+    which keeps the prompt prefix byte-identical between calls.
+    - build: Returns (transcript, uname, messages) for the window of a conversation.
+    - stats: Calls, build time and rendered/reused row counters.
+    """
+    time_format = "%Y-%m-%d %H时%M分%S秒"
+    media_names = {1: '图片', 2: '视频', 3: '语音', 4: '文件'}
+
+    def __init__(self, max_conversations: int = 10000):
+        self.max_conversations = max_conversations
+        self.calls = 0
+        self.seconds = 0.0
+        self.rendered = 0
+        self.reused = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _entry(self, uid: str) -> dict:
+        with self._lock:
+            entry = self._entries.get(uid)
+            if entry is None:
+                entry = {'rows': deque(), 'text': ''}
+                self._entries[uid] = entry
+                while len(self._entries) > self.max_conversations:
+                    self._entries.popitem(last=False)
+            else:
+                self._entries.move_to_end(uid)
+            return entry
+
+    def _render(self, uid: str, d) -> tuple:
+        if d.type != 0 and d.blob is None:
+            return d.id, '', None
+        ti: str = time.strftime(self.time_format, time.localtime(d.time/1000))
+        text = d.text
+        if d.type != 0:
+            # Media is shown by name and blob digest, tools get the digest through PIAMessage.blob.
+            text = "[{}: {}] (blob: {})".format(self.media_names.get(d.type, '附件'), d.text or '', d.blob)
+        return d.id, d.name + f"({ti})" + ": " + text + "\n", PIAMessage(
+            uid = uid,
+            uname = d.name,
+            text = d.text,
+            type = d.type,
+            is_ai = d.is_ai,
+            timestamp = d.time,
+            blob = d.blob
+        )
+
+    def build(self, uid: str, df: list) -> tuple:
+        """Build the transcript of a conversation
+
+        Args:
+            uid (str): The conversation.
+            df (list): The window, PIARecord rows ordered by ID.
+
+        Returns:
+            tuple: (transcript, uname, messages)
+        """
+        t = time.perf_counter()
+        entry = self._entry(uid)
+        rows: deque = entry['rows']
+        if len(rows) > 0 and (len(df) == 0 or df[-1].id < rows[-1][0]):
+            rows.clear()
+            entry['text'] = ''
+        start = df[0].id if len(df) > 0 else 0
+        dropped = False
+        while len(rows) > 0 and rows[0][0] < start:
+            rows.popleft()
+            dropped = True
+        last = rows[-1][0] if len(rows) > 0 else 0
+        new = [self._render(uid, d) for d in df if d.id > last]
+        rows.extend(new)
+        if dropped:
+            entry['text'] = ''.join(r[1] for r in rows)
+        elif len(new) > 0:
+            entry['text'] += ''.join(r[1] for r in new)
+        uname = uid
+        for d in df:
+            if d.is_ai == 0:
+                uname = d.name
+        messages = [r[2] for r in rows if r[2] is not None]
+        with self._lock:
+            self.calls += 1
+            self.rendered += len(new)
+            self.reused += len(rows) - len(new)
+            self.seconds += time.perf_counter() - t
+        return entry['text'], uname, messages
+
+    def stats(self) -> dict:
+        return {
+            'calls': self.calls,
+            'avg_ms': self.seconds * 1000 / self.calls if self.calls > 0 else 0.0,
+            'rendered': self.rendered,
+            'reused': self.reused,
+            'conversations': len(self._entries),
+        }
+
+class PIACompactor:
+    """PIA Compactor
+    Folds the messages that left the history window of a conversation into its
+    stored summary, so old context survives without growing the prompt.
+    Conversations are marked with touch() after a reply; a background thread
+    looks at the marked ones every interval seconds.
+    A conversation is summarized once at least min_rows messages lie between the
+    end of its summary and the start of its window (at most max_rows per call).
+    - window: uid -> the current window, PIARecord rows ordered by ID.
+    - summarize: (previous summary, rows) -> the new summary.
+    """
+    def __init__(self, storage, window: Callable, summarize: Callable,
+        min_rows: int = 20, max_rows: int = 200):
+        self.storage = storage
+        self.window = window
+        self.summarize = summarize
+        self.min_rows = min_rows
+        self.max_rows = max_rows
+        self.compacted = 0
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def touch(self, uid: str):
+        with self._lock:
+            self._dirty.add(uid)
+
+    def compact(self, uid: str) -> bool:
+        """Summarize the messages of a conversation which left its window.
+
+        Returns:
+            bool: True if the summary was updated.
+        """
+        df = self.window(uid)
+        if len(df) == 0:
+            return False
+        summary = self.storage.get_summary(uid)
+        after = 0 if summary is None else summary.last_id
+        rows = self.storage.fetch_range(uid, after, df[0].id, self.max_rows)
+        texts = [d for d in rows if d.type == 0]
+        if len(texts) < self.min_rows:
+            return False
+        text = self.summarize('' if summary is None else summary.text, texts)
+        self.storage.put_summary(uid, text, rows[-1].id, int(time.time()*1000))
+        self.compacted += 1
+        return True
+
+    def run_once(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        for uid in dirty:
+            try:
+                # Several batches may be behind after a long pause, keep going until caught up.
+                while self.compact(uid):
+                    pass
+            except Exception:
+                traceback.print_exc()
+
+    def start(self, interval: float):
+        if self._thread is not None:
+            return
+        def run():
+            while True:
+                time.sleep(interval)
+                self.run_once()
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
@@ -1,5 +1,4 @@
 from classes import PIAListener, PIAMessage, PIAResponseMessage, PIAResponse
-from classes import PIAProcess
 from getopt import GetoptError,getopt
 import socket
 import time
@@ -23,10 +22,10 @@ uid = md5s(os.getcwd())
 
 nw: socket.socket
 
-#conn_state : dict = {}
-conn_state = PIAProcess.Manager().dict()
+# Lives in the listener process only, replies are delivered to this process (sender(channel = True)).
+conn_state : dict = {}
 
-@app.mainloop(keep_alive = False, shared = conn_state)
+@app.mainloop(keep_alive = False)
 def loop(fargs, args, kwargs):
     host = '127.0.0.1'
     port = 8167
@@ -41,7 +40,6 @@ def loop(fargs, args, kwargs):
                 host = arg
             elif opt in ('-p', '--port'):
                 port = int(arg)
-    conn_state = kwargs['shared']
     sk = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sk.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     sk.bind((host, port))
@@ -68,17 +66,39 @@ def loop(fargs, args, kwargs):
         conn_state.pop(uid)
         
 
-@app.sender()
+@app.sender(channel = True)
 def sendto(messages: PIAResponse):
     global conn_state
     message:PIAResponseMessage = messages.messages[0]
     if message.type != 0:
-        return False
-    txt = message.text
+        # A terminal cannot show media, describe it (content is a memoryview of the blob).
+        if message.content is None:
+            return False
+        txt = '[{}] {} ({} bytes)'.format(message.type, message.text or '', len(message.content))
+    else:
+        txt = message.text
     print('>>>AI: ' + txt)
     if messages.t_uid in conn_state.keys():
         cto : socket.socket = conn_state[messages.t_uid]
         cto.send(b'|AI| ')
         cto.send(txt.encode('utf-8'))
         cto.send(b'\n>>> ')
+    return True
+
+streaming = set()
+
+@app.streamer()
+def streamto(messages: PIAResponse, final: bool):
+    global conn_state
+    if messages.t_uid not in conn_state.keys():
+        return False
+    cto : socket.socket = conn_state[messages.t_uid]
+    if final:
+        streaming.discard(messages.t_uid)
+        cto.send(b'\n>>> ')
+        return True
+    if messages.t_uid not in streaming:
+        streaming.add(messages.t_uid)
+        cto.send(b'|AI| ')
+    cto.send(messages.messages[0].text.encode('utf-8'))
     return True
\ No newline at end of file
@@ -7,7 +7,7 @@
 __version__ = '1.0.0'
 
 from checklist import ck as module_check
-from classes import Configure, PIAError, PIAListener, PIAModule, PIAMessage, PIARequest, PIAResponseMessage, PIAResponse
+from classes import Configure, PIAError, PIAListener, PIAModule, PIAMessage, PIARequest, PIAResponseMessage, PIAResponse, tool_registry
 from getopt import getopt, GetoptError
 import sys
 import os
@@ -16,16 +16,26 @@ import platform
 import random
 from rich import print as rprint
 from pydantic import BaseModel, Field
-from typing import List, Optional, Callable
+from typing import Any, List, Optional, Callable
 import sqlite3
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from multiprocess import Process
 import signal
 import time
 import pickle
 import copy
 import traceback
-from backend import ai
+import asyncio
+import json
+from backend import ai, aai, pool, expected_tokens
+from notify import PIANotifier
+from storage import PIAStorage, PIAWriter, open_storage, legacy_tables, migrate_tables
+from scheduler import PIADeadlines, PIAPipeline, PIAPriority
+from aio import PIAAsyncRunner
+from stream import PIAStreamCollector, PIAStreamSink
+from cache import PIALRUCache, PIAResponseCache, MISS
+from context import PIAContextBuilder, PIACompactor
+from blobs import PIABlobStore
 
 HELP_TEXT = """PIA - Intelligent Assistant ({})
 Usage: {} [options] [args]
@@ -39,6 +49,7 @@ Usage: {} [options] [args]
 --debug         Show debug info.
 --daemon        Start daemon mode. (Linux/MacOS only)
 --socket        Setup a simple socket server to debug PIA.
+--migrate       Import legacy chat_* tables into pia_message and exit.
 """.format(platform.platform(),sys.argv[0])
 
 class PIASettings(BaseModel):
@@ -56,8 +67,18 @@ class PIASettings(BaseModel):
     daemon: bool = False
     server: bool = False
     debug: bool = False
+    migrate: bool = False
+    storage: Any = None
+    writer: Any = None
+    runner: Any = None
+    tool_pool: Any = None
+    builder: Any = None
+    compactor: Any = None
+    response_cache: Any = None
+    blobs: Any = None
     
 g_settings = PIASettings()
+g_notifier = PIANotifier()
 
 def show_help():
     print(HELP_TEXT, end='')
@@ -78,306 +99,639 @@ def daemon():
 def show_version():
     print('Version: PIA-Core/{}'.format(__version__))
     
+def main_blobs(settings: PIASettings) -> PIABlobStore:
+    if settings.blobs is None:
+        settings.blobs = PIABlobStore(settings.c.loop.blob_path)
+    return settings.blobs
+
+def main_media(settings: PIASettings, message) -> Optional[str]:
+    """Store the binary content of a non-text message, returns its blob digest (None for text)."""
+    if message.type == 0:
+        return None
+    if message.blob is not None:
+        return message.blob
+    if message.content is not None:
+        return main_blobs(settings).put(message.content)
+    return None
+
+def main_storage(settings: PIASettings) -> PIAStorage:
+    if settings.storage is None:
+        settings.storage = open_storage(settings.c.loop)
+    return settings.storage
+
+def main_listener(settings: PIASettings, tname: str):
+    """Find the listener of a conversation.
+    Returns (listener, uname), listener is None if it is not loaded.
+    """
+    df1 = main_storage(settings).get_listener(tname)
+    if df1 is None:
+        return None, None
+    for l in settings.listeners:
+        if l.uuid == df1[2]:
+            return l, df1[1]
+    return None, df1[1]
+
 def main_send(tp):
     settings: PIASettings = tp[0]
-    tname: str = tp[1][5:]
-    db = sqlite3.connect(settings.c.loop.db_path)
-    cur = db.cursor()
-    cur.execute(
-        '''
-        SELECT UID,UNAME,LISTENER FROM pia_listener WHERE UID = '{}'
-        '''.format(tname)
-    )
-    df1 = cur.fetchall()
-    if len(df1) == 0:
+    tname: str = tp[1]
+    db = main_storage(settings)
+    state = db.get_state(tname)
+    if state is None or state.pending_send == 0:
         return "OK"
-    listener: PIAListener = None
-    for l in settings.listeners:
-        if l.uuid == df1[0][2]:
-            listener = l
-            break
+    listener, uname = main_listener(settings, tname)
     if listener is None:
         return "OK"
-    cur.execute(
-        '''
-        SELECT NAME,TYPE,TEXT,CONTENT,TIME,IS_ME,IS_AI,SENT,ID FROM 
-        chat_{} WHERE SENT = 0 AND IS_DELETED = 0 AND IS_ME = 1
-        '''.format(tname)
-    )
-    df = cur.fetchall()
+    df = db.list_unsent(tname)
     for d in df:
-        if d[1] == 0:
+        if d.type == 0 or d.blob is not None:
             st = listener.i_sender(PIAResponse(
                 t_uid = tname,
-                t_uname = df1[0][1],
+                t_uname = uname,
                 messages = [
                     PIAResponseMessage(
-                        type=0,
-                        uname=d[0],
-                        text=d[2],
-                        timestamp=d[4]
+                        type=d.type,
+                        uname=d.name,
+                        text=d.text,
+                        timestamp=d.time,
+                        # Media is passed as a memoryview of the mapped blob, not copied.
+                        content=None if d.blob is None else main_blobs(settings).get(d.blob),
+                        blob=d.blob
                     )
                 ]
             ))
             if st:
-                cur.execute(
-                    '''
-                    UPDATE chat_{} SET SENT = 1 WHERE ID = {}
-                    '''.format(tname, d[8])
-                )
-                db.commit()
-    db.close()
+                db.mark_sent(tname, d.id)
     return "Sent"
     
-def main_exec(tp):
-    settings: PIASettings = tp[0]
-    tname: str = tp[1][5:]
-    db = sqlite3.connect(settings.c.loop.db_path)
-    cur = db.cursor()
-    cur.execute(
-        '''
-        SELECT NAME,TYPE,TEXT,CONTENT,TIME,IS_ME,IS_AI FROM 
-        chat_{} WHERE IS_DELETED = 0 AND ID > (SELECT MAX(ID) - {} FROM chat_{} WHERE IS_DELETED = 0)
-        '''.format(tname, settings.c.loop.memory, tname)
-    )
-    df = cur.fetchall()
-    if len(df) == 0:
+def main_budget(settings: PIASettings) -> int:
+    """The token budget of the history window for the configured model, 0 for none.
+    LoopConfig.model_memory_tokens overrides LoopConfig.memory_tokens per model,
+    LoopConfig.memory still caps the number of rows.
+    """
+    return settings.c.loop.model_memory_tokens.get(settings.c.context.model, settings.c.loop.memory_tokens)
+
+def main_pending(settings: PIASettings, tname: str):
+    """Check readiness of a conversation.
+    Returns a status string when there is nothing to do, else the recent messages.
+    """
+    db = main_storage(settings)
+    state = db.get_state(tname)
+    if state is None or state.last_id == 0:
         return "No message"
-    if df[-1][5] == 1:
+    if state.last_answered_id >= state.last_id:
         return "Answered"
-    if int(time.time()*1000) - df[-1][4]  < settings.c.loop.max_wait_time * 1000:
+    if int(time.time()*1000) - state.last_in_time  < settings.c.loop.max_wait_time * 1000:
         return "Waiting"
-    respT = ""
-    try:
-        my_tools = []
-        my_tools_table = {}
-        for m in settings.modules:
-            for i,j in m.function_lists.items():
-                jj = copy.deepcopy(j)
-                jj['handler'] = []
-                my_tools.append({
-                    'type' : 'function',
-                    'function' : jj
-                })
-                my_tools_table[i] = j
-        u_prompt = ''
-        uname = tname
-        for d in df:
-            if d[6] == 0:
-                uname = d[0]
-        mess_struct = PIARequest(
-            uid = tname,
-            uname = uname
-        )
-        for d in df:
-            if d[1] == 0:
-                ti: str = time.strftime("%Y-%m-%d %H时%M分%S秒", time.localtime(d[4]/1000))
-                u_prompt += d[0] + f"({ti})" + ": " + d[2] + "\n"
-                mess_struct.messages.append(
-                    PIAMessage(
-                        uid = tname,
-                        uname = d[0],
-                        text = d[2],
-                        type = d[1],
-                        is_ai = d[6],
-                        timestamp = d[4]
-                    )
-                )
-        mess = [
-        {
-                    "role" : "system",
-                    "content" : 
-                    settings.c.context.system_prompt.format(uname, 
-                    time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()))
-        },
-        {
-                    "role" : "user",
-                    "content" : u_prompt
-        }
+    df = main_window(settings, tname)
+    if len(df) == 0:
+        return "No message"
+    return df
+
+def main_window(settings: PIASettings, tname: str) -> list:
+    return main_storage(settings).fetch_recent(tname, settings.c.loop.memory, main_budget(settings))
+
+def main_summarize(settings: PIASettings, previous: str, df: list) -> str:
+    """Fold messages into the previous summary of a conversation."""
+    time_format = PIAContextBuilder.time_format
+    lines = ''.join(
+        d.name + "(" + time.strftime(time_format, time.localtime(d.time/1000)) + "): " + d.text + "\n"
+        for d in df
+    )
+    if previous:
+        lines = "之前的摘要: " + previous + "\n\n" + lines
+    comp = ai.chat.completions.create(
+        model = settings.c.context.summary_model or settings.c.context.model,
+        max_tokens = settings.c.context.summary_max_tokens,
+        messages = [
+            {"role": "system", "content": settings.c.context.summary_prompt},
+            {"role": "user", "content": lines}
         ]
-        #rprint(mess)
-        comp = ai.chat.completions.create(
+    )
+    return comp.choices[0].message.content.strip()
+
+def main_compactor(settings: PIASettings) -> Optional[PIACompactor]:
+    """The summary compactor, None unless LoopConfig.summary_interval is set."""
+    if settings.c.loop.summary_interval <= 0:
+        return None
+    if settings.compactor is None:
+        settings.compactor = PIACompactor(
+            main_storage(settings),
+            window = lambda tname: main_window(settings, tname),
+            summarize = lambda previous, df: main_summarize(settings, previous, df),
+            min_rows = settings.c.loop.summary_min_rows,
+            max_rows = settings.c.loop.summary_max_rows
+        )
+        settings.compactor.start(settings.c.loop.summary_interval)
+    return settings.compactor
+
+def main_builder(settings: PIASettings) -> PIAContextBuilder:
+    if settings.builder is None:
+        settings.builder = PIAContextBuilder()
+    return settings.builder
+
+def main_request(settings: PIASettings, tname: str, df: list, summary = None):
+    """Build the completion request of a conversation.
+    The summary (PIASummary) of the older messages goes before the transcript.
+    Returns (mess, my_tools, my_tools_table, mess_struct).
+    """
+    # ContextConfig.tool_filter maps a UID to the only function names it may use.
+    my_tools = tool_registry.tools(settings.c.context.tool_filter.get(tname))
+    my_tools_table = tool_registry.table()
+    t = time.perf_counter()
+    u_prompt, uname, messages = main_builder(settings).build(tname, df)
+    mess_struct = PIARequest(
+        uid = tname,
+        uname = uname
+    )
+    mess_struct.messages = messages
+    if summary is not None:
+        u_prompt = "之前的对话摘要: " + summary.text + "\n\n" + u_prompt
+    now = time.localtime()
+    if settings.c.context.stable_prefix:
+        # Keep system + transcript identical between calls (prompt caching),
+        # the exact time goes after the transcript.
+        sys_time = time.strftime("%Y-%m-%d", now)
+        u_prompt = u_prompt + "现在时间: " + time.strftime("%Y-%m-%d %H:%M:%S", now) + "\n"
+    else:
+        sys_time = time.strftime("%Y-%m-%d %H:%M:%S", now)
+    mess = [
+    {
+                "role" : "system",
+                "content" : 
+                settings.c.context.system_prompt.format(uname, sys_time)
+    },
+    {
+                "role" : "user",
+                "content" : u_prompt
+    }
+    ]
+    if settings.debug:
+        rprint('Context({}): {:.3f} ms, {}'.format(tname, (time.perf_counter() - t) * 1000, settings.builder.stats()))
+    return mess, my_tools, my_tools_table, mess_struct
+
+def main_strip(respT: str) -> str:
+    if respT.startswith('ME') or respT.startswith('小刘'):
+        respT = respT[respT.find(':')+1:]
+    return respT
+
+def main_reply(comp) -> str:
+    return main_strip(comp.choices[0].message.content)
+
+def main_sink(settings: PIASettings, tname: str) -> Optional[PIAStreamSink]:
+    """A stream sink for the conversation, None if streaming is off or its listener cannot stream."""
+    if not settings.c.context.stream:
+        return None
+    listener, uname = main_listener(settings, tname)
+    if listener is None or not listener.can_stream():
+        return None
+    return PIAStreamSink(listener, tname, uname, strip = main_strip)
+
+def main_streaming(settings: PIASettings, sink: PIAStreamSink):
+    """A drop-in for ai.chat.completions.create which streams the content to sink."""
+    def create(**kwargs):
+        collector = PIAStreamCollector(sink.push, settings.c.context.stream_chunk)
+        for chunk in ai.chat.completions.create(stream = True, stream_options = {'include_usage': True}, **kwargs):
+            collector.feed(chunk)
+        return collector.result()
+    return create
+
+def main_streaming_async(settings: PIASettings, sink: PIAStreamSink):
+    async def create(**kwargs):
+        collector = PIAStreamCollector(sink.push, settings.c.context.stream_chunk)
+        async for chunk in await aai.chat.completions.create(stream = True, stream_options = {'include_usage': True}, **kwargs):
+            collector.feed(chunk)
+        return collector.result()
+    return create
+
+def main_tool_pool(settings: PIASettings) -> ThreadPoolExecutor:
+    if settings.tool_pool is None:
+        settings.tool_pool = ThreadPoolExecutor(max_workers=settings.c.loop.tool_workers)
+    return settings.tool_pool
+
+def main_cached(cache: PIALRUCache, caller: Callable) -> Callable:
+    """Wrap a handler with its result cache, keyed by function name and normalized arguments."""
+    def cached(req: PIARequest, func_name: str, func_args: str):
+        try:
+            key = (func_name, json.dumps(json.loads(func_args), sort_keys=True, separators=(',', ':')))
+        except ValueError:
+            key = (func_name, func_args)
+        resp = cache.get(key)
+        if resp is MISS:
+            resp = caller(req, func_name, func_args)
+            cache.put(key, resp)
+        return resp
+    return cached
+
+def main_tools(settings: PIASettings, tool_calls: list, my_tools_table: dict, mess_struct: PIARequest) -> list:
+    """Run the tool calls of one turn.
+    Consecutive calls of functions registered with parallel=True run at the same time
+    on the tool pool, a parallel=False function runs alone once the calls before it
+    are done. Every call gets its own timeout, and the tool messages are returned
+    in the order of tool_calls.
+    """
+    pool = main_tool_pool(settings)
+    mess = []
+    group = []
+    def start(tool_call):
+        caller = my_tools_table[tool_call.function.name]['handler']
+        cache = tool_registry.cache(tool_call.function.name)
+        if cache is not None:
+            caller = main_cached(cache, caller)
+        group.append((tool_call, time.monotonic(), pool.submit(caller, 
+            mess_struct, 
+            tool_call.function.name, 
+            tool_call.function.arguments
+        )))
+    def finish():
+        for tool_call, st, f in group:
+            timeout = my_tools_table[tool_call.function.name].get('timeout') or settings.c.loop.tool_timeout
+            try:
+                resp = f.result(timeout = max(st + timeout - time.monotonic(), 0))
+            except FutureTimeoutError:
+                resp = 'Error: {} did not finish in {} seconds.'.format(tool_call.function.name, timeout)
+            mess.append({
+                'tool_call_id': tool_call.id,
+                'role': 'tool',
+                "name": tool_call.function.name,
+                "content": resp,
+            })
+        group.clear()
+    for tool_call in tool_calls:
+        if my_tools_table[tool_call.function.name].get('parallel', True):
+            start(tool_call)
+        else:
+            finish()
+            start(tool_call)
+            finish()
+    finish()
+    return mess
+
+def main_complete(settings: PIASettings, req: tuple, create: Callable = None):
+    mess, my_tools, my_tools_table, mess_struct = req
+    if create is None:
+        create = ai.chat.completions.create
+    #rprint(mess)
+    comp = create(
+        model = settings.c.context.model,
+        messages = mess,
+        tool_choice="auto" if len(my_tools) > 0 else None,
+        tools=my_tools if len(my_tools) > 0 else None,
+    )
+    mess.append(comp.choices[0].message)
+    while comp.choices[0].message.tool_calls:
+        tool_calls = comp.choices[0].message.tool_calls
+        mess += main_tools(settings, tool_calls, my_tools_table, mess_struct)
+        comp = create(
             model = settings.c.context.model,
-            messages = mess,
-            tool_choice="auto" if len(my_tools) > 0 else None,
-            tools=my_tools if len(my_tools) > 0 else None,
+            messages = mess
         )
         mess.append(comp.choices[0].message)
-        while comp.choices[0].message.tool_calls:
-            tool_calls = comp.choices[0].message.tool_calls
-            for tool_call in tool_calls:
-                caller = my_tools_table[tool_call.function.name]['handler']
-                args = tool_call.function.arguments
-                resp = caller(
-                    mess_struct, 
-                    tool_call.function.name, 
-                    tool_call.function.arguments
-                )
-                mess.append({
-                    'tool_call_id': tool_call.id,
-                    'role': 'tool',
-                    "name": tool_call.function.name,
-                    "content": resp,
-                })
-            comp = ai.chat.completions.create(
-                model = settings.c.context.model,
-                messages = mess
-            )
-            mess.append(comp.choices[0].message)
-        respT = comp.choices[0].message.content
-        if respT.startswith('ME') or respT.startswith('小刘'):
-            respT = respT[respT.find(':')+1:]
+    return main_reply(comp), comp
+
+async def main_complete_async(settings: PIASettings, req: tuple, create: Callable = None):
+    mess, my_tools, my_tools_table, mess_struct = req
+    if create is None:
+        create = aai.chat.completions.create
+    runner = main_runner(settings)
+    model = settings.c.context.model
+    comp = await runner.call(model, create,
+        model = model,
+        messages = mess,
+        tool_choice="auto" if len(my_tools) > 0 else None,
+        tools=my_tools if len(my_tools) > 0 else None,
+    )
+    mess.append(comp.choices[0].message)
+    while comp.choices[0].message.tool_calls:
+        tool_calls = comp.choices[0].message.tool_calls
+        mess += await asyncio.to_thread(main_tools, settings, tool_calls, my_tools_table, mess_struct)
+        comp = await runner.call(model, create,
+            model = model,
+            messages = mess
+        )
+        mess.append(comp.choices[0].message)
+    return main_reply(comp), comp
+
+def main_response_cache(settings: PIASettings) -> Optional[PIAResponseCache]:
+    """The response cache, None unless ContextConfig.response_cache is set."""
+    if not settings.c.context.response_cache:
+        return None
+    if settings.response_cache is None:
+        settings.response_cache = PIAResponseCache(
+            main_storage(settings),
+            ttl = settings.c.context.response_cache_ttl,
+            max_entries = settings.c.context.response_cache_size
+        )
+    return settings.response_cache
+
+def main_cache_key(settings: PIASettings, df: list, summary, req) -> str:
+    """The response cache key of a request.
+    The system prompt is taken as sent (formatted with the user name and time) and
+    the speakers are part of the key, so a reply is never served to another user.
+    The message times are left out, the time in the system prompt covers them.
+    """
+    return PIAResponseCache.key(
+        settings.c.context.model,
+        req[0][0]['content'],
+        None if summary is None else summary.text,
+        [(d.name, d.is_ai, d.type, d.text) for d in df],
+        req[1]
+    )
+
+def main_cache_get(settings: PIASettings, tname: str, key: str):
+    cache = main_response_cache(settings)
+    respT = cache.get(key)
+    if settings.debug:
+        rprint('Cache({}): {}, {}'.format(tname, 'miss' if respT is MISS else 'hit', cache.stats()))
+    return respT
+
+def main_cache_put(settings: PIASettings, key: str, req, respT: str):
+    # Replies which went through tool calls depend on the tool results, they are not cached.
+    if len(req[0]) == 3:
+        main_response_cache(settings).put(key, respT)
+
+def main_expected(df: list) -> int:
+    """Predict the total tokens of the next completion of a conversation.
+    The usage of the last stored reply, plus the estimate of the messages after it.
+    Returns 0 if the window holds no reply with usage.
+    """
+    after = 0
+    for d in reversed(df):
+        if d.is_me == 1 and d.tokens_all > 0:
+            return d.tokens_all + after
+        after += d.tokens_est
+    return 0
+
+def main_store(settings: PIASettings, tname: str, respT: str, comp, sent: bool = False):
+    main_storage(settings).append_message(
+        tname,
+        name = "ME",
+        text = respT,
+        timestamp = int(time.time()*1000),
+        is_me = 1,
+        is_ai = 1,
+        listener = 'OpenAI',
+        tokens_all = 0 if not comp else comp.usage.total_tokens,
+        tokens_prompt = 0 if not comp else comp.usage.prompt_tokens,
+        sent = 1 if sent else 0
+    )
+    compactor = main_compactor(settings)
+    if compactor is not None:
+        compactor.touch(tname)
+
+def main_exec(tp):
+    settings: PIASettings = tp[0]
+    tname: str = tp[1]
+    df = main_pending(settings, tname)
+    if isinstance(df, str):
+        return df
+    expected_tokens.set(main_expected(df))
+    summary = main_storage(settings).get_summary(tname)
+    sink = None
+    comp = None
+    try:
+        req = main_request(settings, tname, df, summary)
+        key = None
+        respT = MISS
+        if main_response_cache(settings) is not None:
+            key = main_cache_key(settings, df, summary, req)
+            respT = main_cache_get(settings, tname, key)
+        if respT is MISS:
+            sink = main_sink(settings, tname)
+            respT, comp = main_complete(settings, req,
+                create = None if sink is None else main_streaming(settings, sink))
+            if key is not None:
+                main_cache_put(settings, key, req, respT)
     except Exception as e:
         traceback.print_exc()
         respT = settings.c.context.error_format.format(str(e))
         comp = None
-    db.execute(
-        '''
-        INSERT INTO chat_{} (NAME, TEXT, TIME, IS_MENTIONED, IS_ME, IS_AI, LISTENER, TOKENS_ALL, TOKENS_PROMPT) 
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        '''.format(tname),
-        (
-            "ME",
-            respT,
-            int(time.time()*1000),
-            0,
-            1,
-            1,
-            'OpenAI',
-            0 if not comp else comp.usage.total_tokens,
-            0 if not comp else comp.usage.prompt_tokens
-        )
-    )
-    db.commit()
-    db.close()
+    if sink is not None:
+        sink.close()
+    # A streamed reply has already been delivered, unless it or the streamer failed.
+    main_store(settings, tname, respT, comp, sent = sink is not None and sink.delivered and comp is not None)
     return "OK"
+
+async def main_exec_async(settings: PIASettings, tname: str):
+    df = await asyncio.to_thread(main_pending, settings, tname)
+    if isinstance(df, str):
+        return df
+    expected_tokens.set(main_expected(df))
+    summary = await asyncio.to_thread(main_storage(settings).get_summary, tname)
+    sink = None
+    comp = None
+    try:
+        req = main_request(settings, tname, df, summary)
+        key = None
+        respT = MISS
+        if main_response_cache(settings) is not None:
+            key = main_cache_key(settings, df, summary, req)
+            respT = await asyncio.to_thread(main_cache_get, settings, tname, key)
+        if respT is MISS:
+            sink = await asyncio.to_thread(main_sink, settings, tname)
+            respT, comp = await main_complete_async(settings, req,
+                create = None if sink is None else main_streaming_async(settings, sink))
+            if key is not None:
+                await asyncio.to_thread(main_cache_put, settings, key, req, respT)
+    except Exception as e:
+        traceback.print_exc()
+        respT = settings.c.context.error_format.format(str(e) or type(e).__name__)
+        comp = None
+    if sink is not None:
+        sink.close()
+    await asyncio.to_thread(main_store, settings, tname, respT, comp, sink is not None and sink.delivered and comp is not None)
+    return "OK"
+
+def main_runner(settings: PIASettings) -> PIAAsyncRunner:
+    if settings.runner is None:
+        settings.runner = PIAAsyncRunner(
+            max_concurrency = settings.c.loop.max_concurrency,
+            model_concurrency = settings.c.loop.model_concurrency,
+            timeout = settings.c.loop.request_timeout,
+            throttle = pool.throttle
+        )
+    return settings.runner
     
+def main_list(settings: PIASettings):
+    return main_storage(settings).list_conversations()
+
+def main_ready(settings: PIASettings, tables: list, hold: dict = {}):
+    """Split conversations by readiness, using pia_state only.
+    hold maps a UID to the time (ms) before which its failed delivery is not retried.
+
+    Returns:
+        tuple: (ready, waiting), waiting maps UID to the reply deadline (ms).
+    """
+    states = main_storage(settings).get_states(tables)
+    now = int(time.time()*1000)
+    wait = settings.c.loop.max_wait_time * 1000
+    ready = []
+    waiting = {}
+    for i in tables:
+        state = states.get(i)
+        if state is None:
+            continue
+        if state.last_answered_id < state.last_id:
+            if now - state.last_in_time < wait:
+                waiting[i] = state.last_in_time + wait
+                continue
+        elif state.pending_send == 0:
+            continue
+        elif hold.get(i, 0) > now:
+            waiting[i] = hold[i]
+            continue
+        ready.append(i)
+    return ready, waiting
+
+def main_priority(settings: PIASettings, priority: PIAPriority, tname: str) -> float:
+    state = main_storage(settings).get_state(tname)
+    df1 = main_storage(settings).get_listener(tname)
+    first_in_time = state.first_in_time if state is not None and state.first_in_time > 0 else int(time.time()*1000)
+    return priority.key(tname, None if df1 is None else df1[2], first_in_time)
+
+def main_pipeline(settings: PIASettings, requeue: Callable, sent: Callable = lambda tname: None) -> PIAPipeline:
+    """The pipeline of main_loop, sent(tname) is called after each delivery.
+    Generations are capped at max_workers (max_concurrency with use_async), the
+    conversations beyond that are ordered by PIAPriority: LoopConfig.priority_listeners
+    and priority_uids give a head start in seconds, fair_penalty/fair_half_life
+    hold back conversations which were answered recently.
+    """
+    # The executors live as long as the loop, so their workers keep their pooled connections.
+    executor = ThreadPoolExecutor(max_workers=settings.c.loop.max_workers)
+    send_executor = ThreadPoolExecutor(max_workers=settings.c.loop.send_workers)
+    priority = PIAPriority(
+        listeners = settings.c.loop.priority_listeners,
+        uids = settings.c.loop.priority_uids,
+        fair_penalty = settings.c.loop.fair_penalty,
+        half_life = settings.c.loop.fair_half_life
+    )
+    def replied(tname: str, f: Future):
+        if f.exception() is None and f.result() == "OK":
+            priority.served(tname)
+    def generate(tname: str) -> Future:
+        if settings.c.loop.use_async:
+            f = main_runner(settings).submit(main_exec_async(settings, tname))
+        else:
+            f = executor.submit(main_exec, (settings, tname))
+        f.add_done_callback(lambda f: replied(tname, f))
+        return f
+    return PIAPipeline(
+        send_executor,
+        generate = generate,
+        send = lambda tname: (main_send((settings, tname)), sent(tname)),
+        requeue = requeue,
+        max_inflight = settings.c.loop.max_concurrency if settings.c.loop.use_async else settings.c.loop.max_workers,
+        priority = lambda tname: main_priority(settings, priority, tname)
+    )
+
 def main_loop(settings: PIASettings):
+    if not settings.c.loop.event_driven:
+        pipeline = main_pipeline(settings, requeue = lambda tname: None)
+        while True:
+            time.sleep(settings.c.loop.interval)
+            ready, waiting = main_ready(settings, main_list(settings))
+            for i in ready:
+                pipeline.submit(i)
+    # Event-driven mode: only conversations marked dirty by listener_call/module_call
+    # are looked at. Each inbound message (re)sets the conversation's deadline to
+    # last_in_time + max_wait_time, and the loop sleeps until the earliest deadline.
+    # Ready conversations go through the pipeline one by one, a conversation that
+    # needs another look after its run is marked dirty again by the pipeline.
+    # A delivery which left replies unsent is retried after interval seconds,
+    # doubled on every failure up to send_retry_max.
+    hold = {}
+    failures = {}
+    def sent(tname: str):
+        state = main_storage(settings).get_state(tname)
+        if state is None or state.pending_send == 0:
+            failures.pop(tname, None)
+            hold.pop(tname, None)
+            return
+        n = failures.get(tname, 0)
+        failures[tname] = n + 1
+        backoff = min(settings.c.loop.interval * 2 ** n, settings.c.loop.send_retry_max)
+        hold[tname] = int((time.time() + backoff) * 1000)
+        g_notifier.mark(tname)
+    pipeline = main_pipeline(settings, requeue = g_notifier.mark, sent = sent)
+    deadlines = PIADeadlines()
+    dirty = set(main_list(settings))
     while True:
-        time.sleep(settings.c.loop.interval)
-        db = sqlite3.connect(settings.c.loop.db_path)
-        cur = db.cursor()
-        cur.execute(
-            '''
-            SELECT name FROM sqlite_master WHERE type='table' AND name LIKE 'chat_%'
-            '''
+        ready, waiting = main_ready(settings, sorted(dirty), hold)
+        for i in ready:
+            deadlines.discard(i)
+        for i, deadline in waiting.items():
+            deadlines.set(i, deadline)
+        ready += deadlines.pop_due(int(time.time()*1000))
+        for i in ready:
+            pipeline.submit(i)
+        deadline = deadlines.next()
+        timeout = None if deadline is None else max(deadline - time.time()*1000, 0) / 1000
+        dirty = g_notifier.wait(timeout)
+
+def main_mark(settings: PIASettings, tname: str):
+    """Mark a conversation dirty. Only the event-driven loop reads the notifier,
+    a mark nobody reads would stay buffered in the queue of the marking process.
+    """
+    if settings.c.loop.event_driven:
+        g_notifier.mark(tname)
+
+def main_writer(settings: PIASettings) -> PIAWriter:
+    if settings.writer is None:
+        settings.writer = PIAWriter(
+            main_storage(settings),
+            flush_window = settings.c.loop.flush_window,
+            flush_size = settings.c.loop.flush_size,
+            on_commit = lambda uid: main_mark(settings, uid)
         )
-        tables = cur.fetchall()
-        tables = [(settings, i[0]) for i in tables]
-        with ThreadPoolExecutor(max_workers=settings.c.loop.max_workers) as executor:
-            for i in executor.map(main_exec, tables):
-                #print(i)
-                pass
-            for j in executor.map(main_send, tables):
-                #print(j)
-                pass
-            executor.shutdown(wait=True)
+    return settings.writer
 
 def listener_call(message: PIAMessage, listener: PIAListener):
+    """Store an inbound message.
+    The write goes through the group-commit writer, the returned Future
+    resolves to True once the message is durable.
+    """
     #print(message, listener)
-    db = sqlite3.connect(g_settings.c.loop.db_path)
-    cur = db.cursor()
-    cur.execute(
-        '''
-        CREATE TABLE IF NOT EXISTS chat_{} (
-            ID INTEGER PRIMARY KEY AUTOINCREMENT,
-            NAME TEXT NOT NULL,
-            TYPE INTEGER NOT NULL DEFAULT 0,
-            TEXT TEXT,
-            CONTENT BLOB,
-            TIME INTEGER NOT NULL,
-            IS_MENTIONED INTEGER NOT NULL,
-            IS_ME INTEGER NOT NULL,
-            IS_AI INTEGER NOT NULL,
-            IS_DELETED INTEGER NOT NULL DEFAULT 0,
-            SENT INTEGER NOT NULL DEFAULT 0,
-            LISTENER TEXT NOT NULL,
-            TOKENS_ALL INTEGER NOT NULL DEFAULT 0,
-            TOKENS_PROMPT INTEGER NOT NULL DEFAULT 0
-        )
-        '''.format(message.uid)
-    )
-    db.commit()
-    cur.execute(
-        '''
-        CREATE TABLE IF NOT EXISTS pia_listener (
-            UID TEXT UNIQUE PRIMARY KEY,
-            UNAME TEXT NOT NULL,
-            LISTENER TEXT NOT NULL
-        )
-        '''
-    )
-    db.commit()
-    if message.type == 0:
-        db.execute(
-            '''
-            INSERT INTO chat_{} (NAME, TEXT, TIME, IS_MENTIONED, IS_ME, IS_AI, LISTENER) VALUES (?, ?, ?, ?, ?, ?, ?)
-            '''.format(message.uid),
-            (
-                message.uname,
-                message.text,
-                message.timestamp,
-                0,
-                0,
-                message.is_ai,
-                listener.m_name
-            )
-        )
+    ops = []
+    blob = main_media(g_settings, message)
+    if message.type == 0 or blob is not None:
+        ops.append(('append_message', (message.uid,), dict(
+            name = message.uname,
+            text = message.text,
+            timestamp = message.timestamp,
+            is_me = 0,
+            is_ai = message.is_ai,
+            listener = listener.m_name,
+            type = message.type,
+            blob = blob
+        )))
     elif message.type == 8:
         if message.text == 'clear':
-            db.execute(
-                '''
-                UPDATE chat_{} SET IS_DELETED = 1
-                '''.format(message.uid)
-            )
-        
-    db.commit()
-    
-    db.execute(
-        '''
-        INSERT OR IGNORE INTO pia_listener (UID, UNAME, LISTENER) VALUES (?, ?, ?)
-        ''',
-        (
-            message.uid,
-            message.uname,
-            listener.uuid
-        )
-    )
-    db.commit()
-    db.close()
-    return 'OK'
+            ops.append(('clear_conversation', (message.uid,), {}))
+    ops.append(('upsert_listener', (message.uid, message.uname, listener.uuid), {}))
+    return main_writer(g_settings).submit(ops, message.uid)
 
 def module_call(module: PIAModule, response: PIAResponse, direct: bool = True):
     message: PIAResponseMessage
-    db = sqlite3.connect(g_settings.c.loop.db_path)
-    cur = db.cursor()
-    cur.execute(
-        '''
-        SELECT UID,UNAME,LISTENER FROM pia_listener WHERE UID = '{}'
-        '''.format(response.t_uid)
-    )
-    df = cur.fetchall()
-    if len(df) == 0:
+    db = main_storage(g_settings)
+    df = db.get_listener(response.t_uid)
+    if df is None:
         return False
-    tname = df[0][0]
+    tname = df[0]
+    ops = []
     for message in response.messages:
-        if message.type == 0:
-            db.execute(
-                '''
-                INSERT INTO chat_{} (NAME, TEXT, TIME, IS_MENTIONED, IS_ME, IS_AI, LISTENER) VALUES (?, ?, ?, ?, ?, ?, ?)
-                '''.format(tname),
-                (
-                    message.uname,
-                    message.text,
-                    message.timestamp,
-                    0,
-                    1 if direct else 0,
-                    1,
-                    module.m_name
-                )
-            )
-            db.commit()
-    db.close()
+        blob = main_media(g_settings, message)
+        if message.type == 0 or blob is not None:
+            ops.append(('append_message', (tname,), dict(
+                name = message.uname,
+                text = message.text,
+                timestamp = message.timestamp,
+                is_me = 1 if direct else 0,
+                is_ai = 1,
+                listener = module.m_name,
+                type = message.type,
+                blob = blob
+            )))
+    db.write_batch(ops)
+    main_mark(g_settings, tname)
     return True
 
 def sig_exit(signum, frame):
@@ -398,6 +752,7 @@ if __name__ == '__main__':
             'daemon',
             'debug',
             'socket',
+            'migrate',
             'listen=']
         )
     except GetoptError as e:
@@ -426,6 +781,8 @@ if __name__ == '__main__':
             g_settings.debug = True
         elif opt == '--daemon':
             g_settings.daemon = True
+        elif opt == '--migrate':
+            g_settings.migrate = True
     if g_settings.config_file != 'None':
         try:
             c: Configure = Configure()
@@ -442,6 +799,18 @@ if __name__ == '__main__':
             sys.exit(1)
     if g_settings.show_help:
         show_help()
+    if g_settings.migrate:
+        n = migrate_tables(g_settings.c.loop.db_path)
+        print('Migrate: {} table(s) imported into pia_message.'.format(n))
+        sys.exit()
+    if g_settings.c.loop.storage == 'sqlite' and os.path.exists(g_settings.c.loop.db_path):
+        # Conversations of legacy tables would start over in pia_message, migrate them first.
+        db = sqlite3.connect(g_settings.c.loop.db_path)
+        legacy = legacy_tables(db)
+        db.close()
+        if len(legacy) > 0:
+            print('Found {} legacy chat_* table(s), run with --migrate first.'.format(len(legacy)))
+            sys.exit(1)
     if g_settings.server:
         g_settings.listen_lists.append('listeners.lsocket:app')
     if True:
@@ -494,8 +863,10 @@ if __name__ == '__main__':
     
     for l in g_settings.listeners:
         l.set_call(listener_call)
+        l.blob_path = g_settings.c.loop.blob_path
     for m in g_settings.modules:
         m.set_call(module_call)
+        m.blob_path = g_settings.c.loop.blob_path
     g_settings.listeners_process = [l.run() for l in g_settings.listeners]
     g_settings.modules_process = [m.run() for m in g_settings.modules]
     mainl = Process(target=main_loop, args=(g_settings,))
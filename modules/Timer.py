@@ -1,145 +1,362 @@
-from classes import PIAModule, PIAMessage, PIARequest, PIAResponse, PIAResponseMessage
-import requests
-import json
-import time
-import queue
-import sqlite3
-from datetime import datetime, timezone, timedelta
-
-class PriorityQueue:
-    def __init__(self, db_file):
-        self._db_file = db_file
-        self._create_table()
-        self._load_from_db()
-
-    def _create_table(self):
-        conn = sqlite3.connect(self._db_file)
-        cursor = conn.cursor()
-        cursor.execute('CREATE TABLE IF NOT EXISTS priority_queue (priority INTEGER, item TEXT)')
-        conn.commit()
-        conn.close()
-
-    def push(self, priority, item):
-        conn = sqlite3.connect(self._db_file)
-        cursor = conn.cursor()
-        cursor.execute('INSERT INTO priority_queue VALUES (?, ?)', (priority, item))
-        conn.commit()
-        conn.close()
-
-    def pop(self):
-        conn = sqlite3.connect(self._db_file)
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM priority_queue ORDER BY priority DESC LIMIT 1')
-        result = cursor.fetchone()
-        cursor.execute('DELETE FROM priority_queue WHERE priority = ?', (result[0],))
-        conn.commit()
-        conn.close()
-        return result
-
-    def try_pop(self):
-        conn = sqlite3.connect(self._db_file)
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM priority_queue ORDER BY priority DESC LIMIT 1')
-        result = cursor.fetchone()
-        conn.commit()
-        conn.close()
-        return result
-
-    def _load_from_db(self):
-        conn = sqlite3.connect(self._db_file)
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM priority_queue ORDER BY priority DESC')
-        items = cursor.fetchall()
-        self._queue = queue.PriorityQueue()
-        for priority, item in items:
-            self._queue.put((priority, item))
-        conn.close()
-
-
-app = PIAModule(
-    m_name='Timer module',
-    author='hzh',
-    version='0.0.1',
-)
-priority_queue = PriorityQueue('priority_queue.db')
-
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.application import MIMEApplication
-from email.utils import formataddr
-
-app.register(
-    function_name="create_timer",
-    function_description="It is used to send a specified message at a specified time.",
-    function_parameters={
-        "type": "object",
-        "properties": {
-            "timestamp":{
-                "type":"string",
-                "description":"A timestamp for sending messages at a pre-set time.",
-            },
-            "content":{
-                "type":"string",
-                "description":"The content of the message to be sent periodically."
-            },
-        },
-        'required': ['timestamp','content']
-    }
-)
-
-@app.handler(func_list=['create_timer'])
-def creat_timer(req:PIARequest=None, func_name = '', func_args = ''):
-    print(req)
-    args = json.loads(func_args)
-    timestamp=args['timestamp']
-    content=args['content']
-    t_uid=req.uid
-    print("get message:",int(time.time()),timestamp,content,t_uid)
-    priority_queue.push(timestamp,json.dumps({"content":content,"t_uid":t_uid}))
-
-def timestamp_to_beijing_time(timestamp):
-    utc_datetime = datetime.utcfromtimestamp(timestamp).replace(tzinfo=timezone.utc)
-    beijing_timezone = timezone(timedelta(hours=8))
-    beijing_datetime = utc_datetime.astimezone(beijing_timezone)
-    beijing_time_str = beijing_datetime.strftime('%Y-%m-%d %H:%M:%S')
-    return beijing_time_str
-
-@app.mainloop(keep_alive = False)
-def my_mainloop(argv:list = []):
-    print('Timer Bot is running...')
-    while(True):
-        time.sleep(1)
-        nextmessage = priority_queue.try_pop()
-        # print(nextmessage)
-        if nextmessage==None:
-            continue
-        else:
-            nowtime = int(time.time()*1000)
-            if nowtime>=nextmessage[0]:
-                # date_time = datetime.utcfromtimestamp()  # 将毫秒转换为秒并创建 datetime 对象
-                # formatted_date_time = date_time.strftime('%Y-%m-%d %H:%M:%S')
-                formatted_date_time = timestamp_to_beijing_time(nextmessage[0])
-                print(formatted_date_time)
-                print(nextmessage)
-                content = json.loads(nextmessage[1])
-                app.callback(PIAResponse(
-                    t_uid=content["t_uid"],
-                    t_uname = "PIA-Tester",#module_call里面似乎没有用上
-                    messages=[
-                        PIAResponseMessage(
-                            uname='Timer Bot',
-                            text='您好, 时间{}到了了，这是您定时的消息:{}。'.format(formatted_date_time,content["content"]),
-                            type=0,
-                            timestamp=nowtime
-                        )
-                    ]
-                ), direct=True)
-                priority_queue.pop()
-
-
-if __name__ == '__main__':
-    scheduled_time = int(time.time()+2)
-    content = '这是第一个定时任务'
-    priority_queue.push(scheduled_time,json.dumps({"content":content,"t_uid":"123456"}))
+from classes import PIAModule, PIAMessage, PIARequest, PIAResponse, PIAResponseMessage
+import requests
+import json
+import time
+import heapq
+import os
+import sqlite3
+import threading
+import queue
+import multiprocess
+from datetime import datetime, timezone, timedelta
+
+def to_ms(timestamp) -> int:
+    """Timestamps are seconds, values above 1e12 are taken as milliseconds."""
+    t = float(timestamp)
+    return int(t) if t > 1e12 else int(t * 1000)
+
+BEIJING = timezone(timedelta(hours=8))
+
+def _cron_field(field, low, high):
+    """Parse one cron field (*, a, a-b, */n, a-b/n, lists of these) into a sorted list."""
+    values = set()
+    for part in field.split(','):
+        step = 1
+        if '/' in part:
+            part, step = part.split('/')
+            step = int(step)
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = [int(i) for i in part.split('-')]
+        else:
+            start = end = int(part)
+            if step > 1:
+                end = high
+        if start < low or end > high or start > end or step < 1:
+            raise ValueError('Invalid cron field: ' + field)
+        values.update(range(start, end + 1, step))
+    return sorted(values)
+
+def cron_next(expr, after_ms):
+    """The first time (ms) after after_ms matching a 5-field cron expression
+    (minute hour day month weekday, Beijing time), None if there is none within 5 years.
+    """
+    fields = expr.split()
+    if len(fields) != 5:
+        raise ValueError('A cron expression has 5 fields: ' + expr)
+    minutes = _cron_field(fields[0], 0, 59)
+    hours = _cron_field(fields[1], 0, 23)
+    days = _cron_field(fields[2], 1, 31)
+    months = _cron_field(fields[3], 1, 12)
+    weekdays = {d % 7 for d in _cron_field(fields[4], 0, 7)}
+    # Like cron: with both day and weekday restricted, either may match.
+    any_day, any_weekday = fields[2] == '*', fields[4] == '*'
+    after = datetime.fromtimestamp(after_ms / 1000, BEIJING).replace(second=0, microsecond=0) + timedelta(minutes=1)
+    day = after.replace(hour=0, minute=0)
+    for _ in range(366 * 5):
+        if day.month in months:
+            dom, dow = day.day in days, (day.weekday() + 1) % 7 in weekdays
+            if (dom and dow) if any_day or any_weekday else (dom or dow):
+                for h in hours:
+                    for m in minutes:
+                        t = day.replace(hour=h, minute=m)
+                        if t >= after:
+                            return int(t.timestamp() * 1000)
+        day += timedelta(days=1)
+    return None
+
+def every_ms(value):
+    """The interval (ms) of an 'every' rule, at least one second."""
+    every = float(value) * 1000
+    if not 1000 <= every < float('inf'):
+        raise ValueError('The interval must be at least 1 second.')
+    return int(every)
+
+def next_due(rule, due, now):
+    """The next occurrence (ms) of a schedule rule after now, None when it has none.
+    Rules are 'every:<seconds>' or 'cron:<expression>'; missed occurrences are skipped.
+    """
+    kind, _, value = rule.partition(':')
+    if kind == 'every':
+        every = every_ms(value)
+        return due + ((max(now, due) - due) // every + 1) * every
+    if kind == 'cron':
+        return cron_next(value, max(now, due))
+    raise ValueError('Unknown schedule rule: ' + rule)
+
+class TimerQueue:
+    """Timer store
+    Timers live in an indexed WAL table (timer_queue), the timer process keeps the
+    earliest ones in a min-heap: `window` entries (twice that before it is trimmed),
+    the rest is loaded from the (DUE, ID) index when the heap runs out, so millions
+    of timers cost no memory, whether they were loaded or pushed at runtime.
+    push() may be called from any process, it writes the row and wakes the timer
+    process through a multiprocess queue. wait() sleeps until the next deadline
+    (or a new timer), pop_due() returns every due timer at once and done() deletes
+    them after delivery.
+    A recurring timer is a single row with a RULE (see next_due) and an optional END:
+    done() moves its DUE to the next occurrence instead of deleting it.
+    """
+    def __init__(self, db_file, window = 10000):
+        self._db_file = db_file
+        self._window = window
+        self._local = threading.local()
+        self._wake = multiprocess.Queue()
+        self._heap = []
+        self._horizon = None
+        self._exhausted = False
+        self._create_table()
+
+    def _conn(self):
+        if getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self._db_file, timeout = 30)
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return self._local.conn
+
+    def _create_table(self):
+        conn = self._conn()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS timer_queue (
+                ID INTEGER PRIMARY KEY AUTOINCREMENT,
+                DUE INTEGER NOT NULL,
+                ITEM TEXT NOT NULL,
+                RULE TEXT,
+                END_TIME INTEGER
+            )
+        ''')
+        columns = [d[1] for d in conn.execute('PRAGMA table_info(timer_queue)').fetchall()]
+        if 'RULE' not in columns:
+            conn.execute('ALTER TABLE timer_queue ADD COLUMN RULE TEXT')
+            conn.execute('ALTER TABLE timer_queue ADD COLUMN END_TIME INTEGER')
+        conn.execute('CREATE INDEX IF NOT EXISTS timer_queue_due ON timer_queue (DUE, ID)')
+        # Import the timers of the old priority_queue table.
+        cursor = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='priority_queue'")
+        if cursor.fetchone() is not None:
+            rows = conn.execute('SELECT priority, item FROM priority_queue').fetchall()
+            conn.executemany('INSERT INTO timer_queue (DUE, ITEM) VALUES (?, ?)', [(to_ms(p), i) for p, i in rows])
+            conn.execute('DROP TABLE priority_queue')
+        conn.commit()
+
+    def push(self, timestamp, item, rule = None, end = None):
+        """Add a timer, returns its first due time (ms).
+        Without a timestamp, a recurring timer starts at its next occurrence.
+        """
+        now = int(time.time() * 1000)
+        if rule is not None:
+            # Checks the rule now, done() must not fail on it later.
+            next_due(rule, now, now)
+        due = to_ms(timestamp) if timestamp is not None else next_due(rule, now, now)
+        end = None if end is None else to_ms(end)
+        if due is None or (end is not None and due > end):
+            raise ValueError('The timer never fires.')
+        conn = self._conn()
+        cursor = conn.execute('INSERT INTO timer_queue (DUE, ITEM, RULE, END_TIME) VALUES (?, ?, ?, ?)', (due, item, rule, end))
+        conn.commit()
+        self._wake.put((due, cursor.lastrowid))
+        return due
+
+    def _load(self):
+        # Next slice of the index, after everything already loaded.
+        conn = self._conn()
+        if self._horizon is None:
+            rows = conn.execute('SELECT DUE, ID FROM timer_queue ORDER BY DUE, ID LIMIT ?', (self._window,)).fetchall()
+        else:
+            rows = conn.execute(
+                'SELECT DUE, ID FROM timer_queue WHERE (DUE, ID) > (?, ?) ORDER BY DUE, ID LIMIT ?',
+                (*self._horizon, self._window)
+            ).fetchall()
+        for r in rows:
+            heapq.heappush(self._heap, r)
+        if len(rows) > 0:
+            self._horizon = rows[-1]
+        self._exhausted = len(rows) < self._window
+
+    def _drain(self, timeout = None):
+        try:
+            items = [self._wake.get(timeout = timeout) if timeout is None or timeout > 0 else self._wake.get_nowait()]
+        except queue.Empty:
+            return
+        while True:
+            try:
+                items.append(self._wake.get_nowait())
+            except queue.Empty:
+                break
+        for due, id in items:
+            self._schedule(due, id)
+
+    def _schedule(self, due, id):
+        # Timers past the horizon are still in the table, _load() picks them up later.
+        if self._exhausted or self._horizon is None or (due, id) <= self._horizon:
+            heapq.heappush(self._heap, (due, id))
+            if len(self._heap) > 2 * self._window:
+                self._trim()
+
+    def _trim(self):
+        # Keep the earliest window timers (a sorted list is a heap) and move the horizon
+        # back to the last of them, the others stay in the table for _load().
+        self._heap = sorted(self._heap)[:self._window]
+        self._horizon = self._heap[-1]
+        self._exhausted = False
+
+    def next(self):
+        if len(self._heap) == 0 and not self._exhausted:
+            self._load()
+        return self._heap[0][0] if len(self._heap) > 0 else None
+
+    def wait(self, max_wait = 60):
+        """Sleep until the next timer is due or a new timer is pushed."""
+        due = self.next()
+        timeout = max_wait if due is None else min(max((due - time.time() * 1000) / 1000, 0), max_wait)
+        self._drain(timeout)
+
+    def pop_due(self, now = None):
+        """Return [(due, id, item, rule, end)] of every due timer, oldest first."""
+        now = int(time.time() * 1000) if now is None else now
+        ids = []
+        while self.next() is not None and self._heap[0][0] <= now:
+            ids.append(heapq.heappop(self._heap))
+        if len(ids) == 0:
+            return []
+        items = {}
+        conn = self._conn()
+        for i in range(0, len(ids), 500):
+            part = [id for _, id in ids[i:i+500]]
+            cursor = conn.execute(
+                'SELECT ID, ITEM, RULE, END_TIME FROM timer_queue WHERE ID IN ({})'.format(','.join('?' * len(part))), part)
+            items.update((d[0], d[1:]) for d in cursor.fetchall())
+        # A timer can be pushed to the heap twice (load + wake), deliver it once.
+        return [(due, id, *items.pop(id)) for due, id in ids if id in items]
+
+    def done(self, timers, now = None):
+        """Delete delivered timers, move recurring ones to their next occurrence."""
+        now = int(time.time() * 1000) if now is None else now
+        delete, update = [], []
+        for due, id, item, rule, end in timers:
+            due = None if rule is None else next_due(rule, due, now)
+            if due is None or (end is not None and due > end):
+                delete.append((id,))
+            else:
+                update.append((due, id))
+        conn = self._conn()
+        conn.executemany('DELETE FROM timer_queue WHERE ID = ?', delete)
+        conn.executemany('UPDATE timer_queue SET DUE = ? WHERE ID = ?', update)
+        conn.commit()
+        for due, id in update:
+            self._schedule(due, id)
+
+    def __len__(self):
+        return self._conn().execute('SELECT COUNT(*) FROM timer_queue').fetchone()[0]
+
+
+app = PIAModule(
+    m_name='Timer module',
+    author='hzh',
+    version='0.0.1',
+)
+timer_queue = TimerQueue('priority_queue.db')
+
+import smtplib
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.mime.application import MIMEApplication
+from email.utils import formataddr
+
+app.register(
+    function_name="create_timer",
+    function_description="It is used to send a specified message at a specified time.",
+    function_parameters={
+        "type": "object",
+        "properties": {
+            "timestamp":{
+                "type":"string",
+                "description":"A timestamp for sending messages at a pre-set time. For a recurring timer, the first time (optional).",
+            },
+            "content":{
+                "type":"string",
+                "description":"The content of the message to be sent periodically."
+            },
+            "interval":{
+                "type":"number",
+                "description":"Repeat every this many seconds (optional).",
+            },
+            "cron":{
+                "type":"string",
+                "description":"Repeat on a 5-field cron expression 'minute hour day month weekday' in Beijing time, e.g. '0 8 * * *' for every day at 8:00 (optional).",
+            },
+            "end":{
+                "type":"string",
+                "description":"A timestamp after which a recurring timer stops (optional).",
+            },
+        },
+        'required': ['content']
+    }
+)
+
+@app.handler(func_list=['create_timer'])
+def creat_timer(req:PIARequest=None, func_name = '', func_args = ''):
+    print(req)
+    args = json.loads(func_args)
+    timestamp=args.get('timestamp')
+    content=args['content']
+    t_uid=req.uid
+    rule = None
+    if args.get('interval'):
+        rule = 'every:{}'.format(float(args['interval']))
+    elif args.get('cron'):
+        rule = 'cron:' + args['cron']
+    if timestamp is None and rule is None:
+        return 'Failed, reason: a timestamp, an interval or a cron expression is required'
+    print("get message:",int(time.time()),timestamp,rule,content,t_uid)
+    try:
+        due = timer_queue.push(timestamp,json.dumps({"content":content,"t_uid":t_uid}),rule,args.get('end'))
+    except ValueError as e:
+        return 'Failed, reason: ' + str(e)
+    if rule is None:
+        return 'Timer created for {}'.format(timestamp_to_beijing_time(due / 1000))
+    return 'Recurring timer created, first at {}'.format(timestamp_to_beijing_time(due / 1000))
+
+def timestamp_to_beijing_time(timestamp):
+    utc_datetime = datetime.utcfromtimestamp(timestamp).replace(tzinfo=timezone.utc)
+    beijing_timezone = timezone(timedelta(hours=8))
+    beijing_datetime = utc_datetime.astimezone(beijing_timezone)
+    beijing_time_str = beijing_datetime.strftime('%Y-%m-%d %H:%M:%S')
+    return beijing_time_str
+
+@app.mainloop(keep_alive = False)
+def my_mainloop(argv:list = []):
+    print('Timer Bot is running...')
+    while(True):
+        timer_queue.wait()
+        due_timers = timer_queue.pop_due()
+        if len(due_timers) == 0:
+            continue
+        nowtime = int(time.time()*1000)
+        for due, id, item, rule, end in due_timers:
+            formatted_date_time = timestamp_to_beijing_time(due / 1000)
+            print(formatted_date_time)
+            print(item)
+            content = json.loads(item)
+            app.callback(PIAResponse(
+                t_uid=content["t_uid"],
+                t_uname = "PIA-Tester",#module_call里面似乎没有用上
+                messages=[
+                    PIAResponseMessage(
+                        uname='Timer Bot',
+                        text='您好, 时间{}到了了，这是您定时的消息:{}。'.format(formatted_date_time,content["content"]),
+                        type=0,
+                        timestamp=nowtime
+                    )
+                ]
+            ), direct=True)
+        timer_queue.done(due_timers)
+
+
+if __name__ == '__main__':
+    scheduled_time = int(time.time()+2)
+    content = '这是第一个定时任务'
+    timer_queue.push(scheduled_time,json.dumps({"content":content,"t_uid":"123456"}))
     app.mainloop_handler()
\ No newline at end of file
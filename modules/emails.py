@@ -1,170 +1,421 @@
-#!/usr/bin/env python3
-from classes import PIAModule, PIAMessage, PIARequest, PIAResponse, PIAResponseMessage
-import requests
-import json
-import time
-
-app = PIAModule(
-    m_name='Email module',
-    author='hzh',
-    version='0.0.1',
-)
-test_receiver = {"name":"xxx","useraddress":"xxx"}
-test_sender = {"name":"人工智障","useraddress":"xxx","password":"xxx"}
-test_content = {
-                "title":"这是一个标题",
-                "text":"这是正文",
-                "attachments":[{"name":"附件1.txt","content": b'\xe8\xbf\x99\xe6\x98\xaf\xe4\xb8\x80\xe4\xb8\xaa\xe6\xb5\x8b\xe8\xaf\x95\xe9\x99\x84\xe4\xbb\xb6'.decode('utf-8')},
-                               {"name":"附件2.txt","content": b'\xe8\xbf\x99\xe6\x98\xaf\xe4\xb8\x80\xe4\xb8\xaa\xe6\xb5\x8b\xe8\xaf\x95\xe9\x99\x84\xe4\xbb\xb6'.decode('utf-8')}]
-                }
-
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.application import MIMEApplication
-from email.utils import formataddr
-
-app.register(
-    function_name="send_emails",
-    function_description="send emails to subscriber",
-    function_parameters={
-        "type": "object",
-        "properties": {
-            "sublist" : {
-                "type": "array",
-                "items": {
-                    "type": "object",
-                    "properties": {
-                        "name":{
-                            "type":"string",
-                            "description": "subscriber name",
-                        },
-                        "useraddress":{
-                            "type":"string",
-                            "description": "subscriber's email address",
-                        }
-                    },
-                    "required": ["name","useraddress"],
-                    "description": "One subscriber's information"
-                },
-                "description": "A list of subscriber's information"
-            },
-            "content" : {
-                "type": "object",
-                "properties": {
-                    "title":{
-                        "type":"string",
-                        "description":"email title",
-                    },
-                    "text":{
-                        "type":"string",
-                        "description":"body text",
-                    },
-                    "attachments":{
-                        "type": "array",
-                        "items": {
-                            "type": "object",
-                            "properties": {
-                                "name":{
-                                    "type":"string",
-                                    "description":"Attachment name",
-                                },
-                                "content": {
-                                    "type":"string",
-                                    "description":"Binary attachment content,decoded by utf-8"
-                                }
-                            },
-                            "description": "one attachment"
-                         },
-                        "description": "A list of attachments"
-                    }
-                },
-                "required": ["title","text"]
-            },
-            "sender" : {
-                "type": "object",
-                "properties": {
-                    "name":{
-                        "type":"string",
-                        "description":"sender name",
-                    },
-                    "useraddress":{
-                        "type":"string",
-                        "description":"sender's email address",
-                    },
-                    "password":{
-                        "type":"string",
-                        "description":"sender's email password"
-                    }
-                },
-                "required": ["name","useraddress","password"]
-            }
-        },
-        # "required": ["sublist","sender","content"]
-        "required": ["sublist","content"]
-    }
-)
-
-def smtp_login_obj(username,password):#password有时候要求是授权码
-    smtp_obj = smtplib.SMTP_SSL("smtp.qq.com".encode(),465)#连接到SMTP服务器的端口号
-    smtp_obj.login(username, password)
-    return smtp_obj#函数返回已经登录的 SMTP 对象 smtp_obj
-
-def gen_content_obj(content):#password有时候要求是授权码
-    msg = MIMEMultipart()
-    try:
-        msg['Subject'] = content['title']
-        text = MIMEText(content["text"], 'plain', 'utf-8')
-        msg.attach(text)
-    except Exception as e:
-        print(f"Error occurred : {e}")
-    if "attachments" in content:
-        try:
-            for attachment in content["attachments"]:
-                obj = MIMEApplication(attachment["content"].encode('utf-8'))
-                obj.add_header('Content-Disposition', 'attachment', filename=attachment["name"])
-                msg.attach(obj)
-        except Exception as e:
-            print(f"Error occurred : {e}")
-    return msg
-
-@app.handler(func_list=['send_emails'])
-def my_send_emails(req:PIARequest = None, func_name = '', func_args = ''):
-    args = json.loads(func_args)
-    sublist=args['sublist']
-    content=args['content']
-    print(content)
-    # sender=args['sender']
-    # content = test_content
-    sender = test_sender
-    try:
-        with smtp_login_obj(sender["useraddress"], sender["password"]) as smtp_obj:
-            for receiver in sublist:
-                try:
-                    msg = gen_content_obj(content=content)
-                    msg['From'] = formataddr((sender["name"], sender["useraddress"]))
-                    msg['To'] = formataddr((receiver["name"], receiver["useraddress"]))
-                    # print(receiver["name"], receiver["useraddress"], sender["useraddress"])
-                    # print(msg.as_string())
-                    smtp_obj.sendmail(sender["useraddress"], receiver["useraddress"], msg.as_string())
-                    print('Sent to: ' + receiver["useraddress"])
-                except Exception as e:
-                    print(f"Error occurred when sending email to {receiver['useraddress']}: {e}")
-        return 'Successful'
-    except Exception as e:
-        print(f"Error occurred while handling SMTP connection: {e}")
-        return 'Failed, reason: ' + str(e)
-
-@app.mainloop(keep_alive = False)
-def my_mainloop(argv:list = []):
-    print('Email Bot is running...')
-
-
-if __name__ == '__main__':
-    #单独测试的时候直接运行这个文件
-    app.function_lists['send_emails']['handler'](PIARequest(),'email',json.dumps({
-            "sublist" : [test_receiver,],
-            "sender" : test_sender,
-            "content" : test_content
-        })
-    )
\ No newline at end of file
+#!/usr/bin/env python3
+from classes import PIAModule, PIAMessage, PIARequest, PIAResponse, PIAResponseMessage
+from blobs import PIABlobStore
+import requests
+import json
+import time
+import os
+import queue
+import sqlite3
+import threading
+import multiprocess
+from concurrent.futures import ThreadPoolExecutor
+
+app = PIAModule(
+    m_name='Email module',
+    author='hzh',
+    version='0.0.1',
+)
+test_receiver = {"name":"xxx","useraddress":"xxx"}
+test_sender = {"name":"人工智障","useraddress":"xxx","password":"xxx"}
+test_content = {
+                "title":"这是一个标题",
+                "text":"这是正文",
+                "attachments":[{"name":"附件1.txt","content": b'\xe8\xbf\x99\xe6\x98\xaf\xe4\xb8\x80\xe4\xb8\xaa\xe6\xb5\x8b\xe8\xaf\x95\xe9\x99\x84\xe4\xbb\xb6'.decode('utf-8')},
+                               {"name":"附件2.txt","content": b'\xe8\xbf\x99\xe6\x98\xaf\xe4\xb8\x80\xe4\xb8\xaa\xe6\xb5\x8b\xe8\xaf\x95\xe9\x99\x84\xe4\xbb\xb6'.decode('utf-8')}]
+                }
+
+import smtplib
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.mime.application import MIMEApplication
+from email.utils import formataddr
+
+OUTBOX_DB = 'email_outbox.db'
+POOL_SIZE = 4      # SMTP connections, also the number of concurrent deliveries
+KEEPALIVE = 60     # Seconds a connection may idle before it is checked with NOOP
+MAX_TRIES = 3
+
+app.register(
+    function_name="send_emails",
+    function_description="send emails to subscriber",
+    function_parameters={
+        "type": "object",
+        "properties": {
+            "sublist" : {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "name":{
+                            "type":"string",
+                            "description": "subscriber name",
+                        },
+                        "useraddress":{
+                            "type":"string",
+                            "description": "subscriber's email address",
+                        }
+                    },
+                    "required": ["name","useraddress"],
+                    "description": "One subscriber's information"
+                },
+                "description": "A list of subscriber's information"
+            },
+            "content" : {
+                "type": "object",
+                "properties": {
+                    "title":{
+                        "type":"string",
+                        "description":"email title",
+                    },
+                    "text":{
+                        "type":"string",
+                        "description":"body text",
+                    },
+                    "attachments":{
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "name":{
+                                    "type":"string",
+                                    "description":"Attachment name",
+                                },
+                                "content": {
+                                    "type":"string",
+                                    "description":"Text attachment content"
+                                },
+                                "blob": {
+                                    "type":"string",
+                                    "description":"The blob digest of a file/image/audio from the conversation, instead of content"
+                                }
+                            },
+                            "description": "one attachment"
+                         },
+                        "description": "A list of attachments"
+                    }
+                },
+                "required": ["title","text"]
+            },
+            "sender" : {
+                "type": "object",
+                "properties": {
+                    "name":{
+                        "type":"string",
+                        "description":"sender name",
+                    },
+                    "useraddress":{
+                        "type":"string",
+                        "description":"sender's email address",
+                    },
+                    "password":{
+                        "type":"string",
+                        "description":"sender's email password"
+                    }
+                },
+                "required": ["name","useraddress","password"]
+            }
+        },
+        # "required": ["sublist","sender","content"]
+        "required": ["sublist","content"]
+    }
+)
+
+def smtp_login_obj(username,password):#password有时候要求是授权码
+    smtp_obj = smtplib.SMTP_SSL("smtp.qq.com".encode(),465)#连接到SMTP服务器的端口号
+    smtp_obj.login(username, password)
+    return smtp_obj#函数返回已经登录的 SMTP 对象 smtp_obj
+
+class SMTPPool:
+    """A pool of logged-in SMTP connections.
+    Idle connections are kept and checked with NOOP after KEEPALIVE seconds,
+    a connection which dropped is replaced by a new login and the mail is sent again.
+    Errors answered by the server are raised as is, the connection goes back to the pool.
+    """
+    def __init__(self, username, password, size = POOL_SIZE, keepalive = KEEPALIVE):
+        self.username = username
+        self.password = password
+        self.keepalive = keepalive
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _alive(self, smtp_obj, last_used):
+        if time.time() - last_used < self.keepalive:
+            return True
+        try:
+            return smtp_obj.noop()[0] == 250
+        except Exception:
+            return False
+
+    def acquire(self):
+        self._slots.acquire()
+        try:
+            while True:
+                try:
+                    smtp_obj, last_used = self._idle.get_nowait()
+                except queue.Empty:
+                    return smtp_login_obj(self.username, self.password)
+                if self._alive(smtp_obj, last_used):
+                    return smtp_obj
+                self._close(smtp_obj)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, smtp_obj, broken = False):
+        if broken:
+            self._close(smtp_obj)
+        else:
+            self._idle.put((smtp_obj, time.time()))
+        self._slots.release()
+
+    def _close(self, smtp_obj):
+        try:
+            smtp_obj.close()
+        except Exception:
+            pass
+
+    def sendmail(self, from_addr, to_addr, data):
+        for attempt in range(2):
+            smtp_obj = self.acquire()
+            try:
+                smtp_obj.sendmail(from_addr, to_addr, data)
+            except smtplib.SMTPServerDisconnected:
+                self.release(smtp_obj, broken = True)
+                if attempt == 1:
+                    raise
+                continue
+            except smtplib.SMTPException:
+                # The server answered (refused a recipient, the sender or the data),
+                # smtplib has reset the session and the connection can be used again.
+                self.release(smtp_obj)
+                raise
+            except OSError:
+                # SMTPException is an OSError too, only connection errors get here.
+                self.release(smtp_obj, broken = True)
+                if attempt == 1:
+                    raise
+                continue
+            except Exception:
+                self.release(smtp_obj)
+                raise
+            self.release(smtp_obj)
+            return
+
+class Outbox:
+    """The durable email outbox (sqlite).
+    A job keeps the rendered message once (without the To header) and one row per
+    recipient. The tool call only writes the job, the module process delivers it
+    and records the progress of every recipient, so a restart resumes where it stopped.
+    Recipient status: 0 pending, 1 sent, 2 failed (after MAX_TRIES).
+    """
+    def __init__(self, db_file):
+        self._db_file = db_file
+        self._local = threading.local()
+        self._wake = multiprocess.Queue()
+        conn = self._conn()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS email_job (
+                ID INTEGER PRIMARY KEY AUTOINCREMENT,
+                SENDER_NAME TEXT NOT NULL,
+                SENDER_ADDRESS TEXT NOT NULL,
+                DATA BLOB NOT NULL,
+                CREATED INTEGER NOT NULL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS email_outbox (
+                ID INTEGER PRIMARY KEY AUTOINCREMENT,
+                JOB_ID INTEGER NOT NULL,
+                NAME TEXT NOT NULL,
+                ADDRESS TEXT NOT NULL,
+                STATUS INTEGER NOT NULL DEFAULT 0,
+                TRIES INTEGER NOT NULL DEFAULT 0,
+                NEXT_TRY INTEGER NOT NULL DEFAULT 0,
+                ERROR TEXT
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS email_outbox_pending ON email_outbox (NEXT_TRY) WHERE STATUS = 0')
+        conn.execute('CREATE INDEX IF NOT EXISTS email_outbox_job ON email_outbox (JOB_ID, STATUS)')
+        conn.commit()
+
+    def _conn(self):
+        if getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self._db_file, timeout = 30)
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return self._local.conn
+
+    def enqueue(self, sender, sublist, data):
+        conn = self._conn()
+        with conn:
+            cursor = conn.execute(
+                'INSERT INTO email_job (SENDER_NAME, SENDER_ADDRESS, DATA, CREATED) VALUES (?, ?, ?, ?)',
+                (sender["name"], sender["useraddress"], data, int(time.time()))
+            )
+            job_id = cursor.lastrowid
+            conn.executemany(
+                'INSERT INTO email_outbox (JOB_ID, NAME, ADDRESS) VALUES (?, ?, ?)',
+                [(job_id, r["name"], r["useraddress"]) for r in sublist]
+            )
+        self._wake.put(job_id)
+        return job_id
+
+    def pending(self, limit = 1000):
+        cursor = self._conn().execute(
+            'SELECT ID, JOB_ID, NAME, ADDRESS, TRIES FROM email_outbox WHERE STATUS = 0 AND NEXT_TRY <= ? ORDER BY ID LIMIT ?',
+            (int(time.time()), limit)
+        )
+        return cursor.fetchall()
+
+    def job(self, job_id):
+        cursor = self._conn().execute('SELECT SENDER_NAME, SENDER_ADDRESS, DATA FROM email_job WHERE ID = ?', (job_id,))
+        return cursor.fetchone()
+
+    def record(self, results):
+        """Store delivery results, [(rid, tries, error)] with error None when sent."""
+        now = int(time.time())
+        conn = self._conn()
+        with conn:
+            conn.executemany(
+                'UPDATE email_outbox SET STATUS = ?, TRIES = ?, NEXT_TRY = ?, ERROR = ? WHERE ID = ?',
+                [(1 if e is None else 2 if t >= MAX_TRIES else 0, t, now + 30 * t, e, rid) for rid, t, e in results]
+            )
+
+    def wait(self, max_wait = 60):
+        """Sleep until a job is queued or the next retry is due."""
+        cursor = self._conn().execute('SELECT MIN(NEXT_TRY) FROM email_outbox WHERE STATUS = 0')
+        next_try = cursor.fetchone()[0]
+        timeout = max_wait if next_try is None else min(max(next_try - time.time(), 0), max_wait)
+        try:
+            self._wake.get(timeout = timeout) if timeout > 0 else self._wake.get_nowait()
+            while True:
+                self._wake.get_nowait()
+        except queue.Empty:
+            pass
+
+    def status(self, job_id):
+        cursor = self._conn().execute(
+            'SELECT STATUS, COUNT(*) FROM email_outbox WHERE JOB_ID = ? GROUP BY STATUS', (job_id,))
+        counts = dict(cursor.fetchall())
+        failed = self._conn().execute(
+            'SELECT ADDRESS, ERROR FROM email_outbox WHERE JOB_ID = ? AND STATUS = 2 LIMIT 20', (job_id,)).fetchall()
+        return {
+            "job_id": job_id,
+            "total": sum(counts.values()),
+            "pending": counts.get(0, 0),
+            "sent": counts.get(1, 0),
+            "failed": counts.get(2, 0),
+            "errors": [{"useraddress": a, "error": e} for a, e in failed],
+        }
+
+outbox = Outbox(OUTBOX_DB)
+
+def gen_content_obj(content):#password有时候要求是授权码
+    msg = MIMEMultipart()
+    try:
+        msg['Subject'] = content['title']
+        text = MIMEText(content["text"], 'plain', 'utf-8')
+        msg.attach(text)
+    except Exception as e:
+        print(f"Error occurred : {e}")
+    if "attachments" in content:
+        try:
+            for attachment in content["attachments"]:
+                if attachment.get("blob"):
+                    # Binary content is read from the blob store, no utf-8 round trip.
+                    obj = MIMEApplication(bytes(PIABlobStore(app.blob_path).get(attachment["blob"])))
+                else:
+                    obj = MIMEApplication(attachment["content"].encode('utf-8'))
+                obj.add_header('Content-Disposition', 'attachment', filename=attachment["name"])
+                msg.attach(obj)
+        except Exception as e:
+            print(f"Error occurred : {e}")
+    return msg
+
+app.register(
+    function_name="email_status",
+    function_description="Check the delivery progress of an email job created by send_emails",
+    function_parameters={
+        "type": "object",
+        "properties": {
+            "job_id": {
+                "type": "integer",
+                "description": "The job id returned by send_emails",
+            }
+        },
+        "required": ["job_id"]
+    }
+)
+
+def gen_message_bytes(content, sender):
+    """Render the message once, every recipient only gets its own To header in front."""
+    msg = gen_content_obj(content=content)
+    msg['From'] = formataddr((sender["name"], sender["useraddress"]))
+    return msg.as_bytes(policy=msg.policy.clone(linesep="\r\n"))
+
+@app.handler(func_list=['send_emails'])
+def my_send_emails(req:PIARequest = None, func_name = '', func_args = ''):
+    args = json.loads(func_args)
+    sublist=args['sublist']
+    content=args['content']
+    print(content)
+    # sender=args['sender']
+    # content = test_content
+    sender = test_sender
+    try:
+        job_id = outbox.enqueue(sender, sublist, gen_message_bytes(content, sender))
+    except Exception as e:
+        print(f"Error occurred while queueing emails: {e}")
+        return 'Failed, reason: ' + str(e)
+    return 'Queued, job_id: {}, {} recipient(s). Use email_status to check the progress.'.format(job_id, len(sublist))
+
+@app.handler(func_list=['email_status'])
+def my_email_status(req:PIARequest = None, func_name = '', func_args = ''):
+    args = json.loads(func_args)
+    return json.dumps(outbox.status(int(args['job_id'])), ensure_ascii=False)
+
+def deliver(pool, jobs, row):
+    rid, job_id, name, address, tries = row
+    sender_name, sender_address, data = jobs[job_id]
+    try:
+        header = 'To: {}\r\n'.format(formataddr((name, address))).encode('utf-8')
+        pool.sendmail(sender_address, address, header + data)
+        print('Sent to: ' + address)
+        return rid, tries + 1, None
+    except smtplib.SMTPRecipientsRefused as e:
+        # The address is rejected, retrying will not help.
+        print(f"Error occurred when sending email to {address}: {e}")
+        return rid, MAX_TRIES, str(e)
+    except Exception as e:
+        print(f"Error occurred when sending email to {address}: {e}")
+        return rid, tries + 1, str(e)
+
+@app.mainloop(keep_alive = False)
+def my_mainloop(argv:list = []):
+    print('Email Bot is running...')
+    pool = SMTPPool(test_sender["useraddress"], test_sender["password"])
+    with ThreadPoolExecutor(max_workers = POOL_SIZE) as executor:
+        while True:
+            rows = outbox.pending()
+            if len(rows) == 0:
+                outbox.wait()
+                continue
+            jobs = {}
+            for row in rows:
+                if row[1] not in jobs:
+                    jobs[row[1]] = outbox.job(row[1])
+            outbox.record(list(executor.map(lambda row: deliver(pool, jobs, row), rows)))
+
+
+if __name__ == '__main__':
+    #单独测试的时候直接运行这个文件
+    print(app.function_lists['send_emails']['handler'](PIARequest(),'email',json.dumps({
+            "sublist" : [test_receiver,],
+            "sender" : test_sender,
+            "content" : test_content
+        })
+    ))
+    my_mainloop()
\ No newline at end of file
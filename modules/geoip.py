@@ -1,4 +1,4 @@
-from classes import PIAModule, PIARequest
+from classes import PIAModule, PIARequest, PIACachePolicy
 
 import requests
 import json
@@ -33,7 +33,9 @@ app.register(
             }
         },
         'required': ['ip']
-    }
+    },
+    # 同一个IP的查询结果在短时间内不会变化, 允许PIA-Core缓存
+    cache=PIACachePolicy(idempotent=True, ttl=600, max_entries=4096)
 )
 
 def get_ip_geo(ip:str) -> str:
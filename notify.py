@@ -0,0 +1,44 @@
+#######################
+# AI Assistant Python Framework
+# Date: 2024-01-25
+#######################
+
+__all__ = ['PIANotifier']
+
+import multiprocess as PIAProcess
+import queue
+
+class PIANotifier:
+    """PIA Notifier
+    Cross-process channel used to mark conversations as dirty.
+    It must be created before listener/module processes are started,
+    so that every process shares the same underlying queue.
+    - mark: Mark a conversation as dirty (called by listeners and modules).
+    - wait: Block until at least one conversation is dirty, then drain the channel.
+    """
+    def __init__(self):
+        self._queue = PIAProcess.Queue()
+
+    def mark(self, uid: str):
+        self._queue.put(uid)
+
+    def wait(self, timeout: float = None) -> set:
+        """Wait for dirty conversations
+
+        Args:
+            timeout (float, optional): Seconds to wait, None means wait forever. Defaults to None.
+
+        Returns:
+            set: The uids marked dirty since the last call, empty on timeout.
+        """
+        dirty = set()
+        try:
+            dirty.add(self._queue.get(timeout=timeout))
+        except queue.Empty:
+            return dirty
+        while True:
+            try:
+                dirty.add(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return dirty
@@ -0,0 +1,198 @@
+#######################
+# AI Assistant Python Framework
+# Date: 2024-01-25
+#######################
+
+__all__ = ['PIADeadlines', 'PIAPriority', 'PIAPipeline']
+
+from concurrent.futures import Executor, Future
+from typing import Callable, List, Optional
+import heapq
+import itertools
+import math
+import threading
+import time
+import traceback
+
+class PIADeadlines:
+    """PIA Deadlines
+    A min-heap of per-conversation deadlines used to debounce replies.
+    Setting a new deadline for a UID is O(log n): the old heap entry is left in
+    place and skipped when it reaches the top (lazy deletion).
+    - set: Set (or reset) the deadline of a conversation.
+    - discard: Forget the deadline of a conversation.
+    - next: The earliest pending deadline.
+    - pop_due: Remove and return every conversation whose deadline has passed.
+    """
+    def __init__(self):
+        self._heap = []
+        self._deadline = {}
+
+    def __len__(self) -> int:
+        return len(self._deadline)
+
+    def set(self, uid: str, deadline: float):
+        if self._deadline.get(uid) == deadline:
+            return
+        self._deadline[uid] = deadline
+        heapq.heappush(self._heap, (deadline, uid))
+        if len(self._heap) > 2 * len(self._deadline) + 1024:
+            self._compact()
+
+    def discard(self, uid: str):
+        self._deadline.pop(uid, None)
+
+    def next(self) -> Optional[float]:
+        self._drop_stale()
+        if len(self._heap) == 0:
+            return None
+        return self._heap[0][0]
+
+    def pop_due(self, now: float) -> List[str]:
+        due = []
+        self._drop_stale()
+        while len(self._heap) > 0 and self._heap[0][0] <= now:
+            deadline, uid = heapq.heappop(self._heap)
+            del self._deadline[uid]
+            due.append(uid)
+            self._drop_stale()
+        return due
+
+    def _drop_stale(self):
+        while len(self._heap) > 0 and self._deadline.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def _compact(self):
+        self._heap = [(d, u) for u, d in self._deadline.items()]
+        heapq.heapify(self._heap)
+
+class PIAPriority:
+    """PIA Priority
+    Orders ready conversations when generation is saturated.
+    key() is a virtual arrival time in seconds, lower keys are served first:
+    the time of the oldest unanswered message, minus the head start (seconds)
+    of its listener and of its UID, plus fair_penalty seconds for every reply the
+    UID got recently. That count decays with half_life seconds, so a busy
+    conversation falls behind the quiet ones but is never starved.
+    - key: The key of a conversation.
+    - served: Count a reply for a UID.
+    """
+    def __init__(self, listeners: dict = {}, uids: dict = {}, fair_penalty: float = 10, half_life: float = 300):
+        self.listeners = dict(listeners)
+        self.uids = dict(uids)
+        self.fair_penalty = fair_penalty
+        self.half_life = half_life
+        self._load = {}
+        self._lock = threading.Lock()
+
+    def _decayed(self, uid: str, now: float) -> float:
+        load, t = self._load.get(uid, (0.0, now))
+        return load * math.pow(0.5, (now - t) / self.half_life) if self.half_life > 0 else 0.0
+
+    def served(self, uid: str):
+        now = time.monotonic()
+        with self._lock:
+            self._load[uid] = (self._decayed(uid, now) + 1, now)
+            if len(self._load) > 100000:
+                # Forget the conversations which have decayed to nothing.
+                self._load = {u: v for u, v in self._load.items() if self._decayed(u, now) >= 0.01}
+
+    def key(self, uid: str, listener: str, first_in_time: int) -> float:
+        with self._lock:
+            load = self._decayed(uid, time.monotonic())
+        return (first_in_time / 1000
+            - self.listeners.get(listener, 0)
+            - self.uids.get(uid, 0)
+            + self.fair_penalty * load)
+
+class PIAPipeline:
+    """PIA Pipeline
+    Moves every conversation independently through
+    ready -> generating -> persisted -> sending, and forgets it once sent.
+    Sending starts as soon as the reply of that conversation is stored,
+    it never waits for other conversations.
+    A conversation is never generated twice at the same time: submitting one
+    that is still in flight only flags it, and requeue(uid) is called when the
+    current run ends (also when generation returned "Waiting").
+    - generate: uid -> Future of the main_exec status.
+    - send: uid -> None, runs on send_executor (kept apart from generation,
+      so deliveries never queue behind slow completions).
+    - max_inflight: At most this many generations at once, 0 for no limit.
+      Further conversations wait in the 'ready' stage, ordered by priority.
+    - priority: uid -> sort key, lower first (see PIAPriority). Defaults to arrival order.
+    """
+    def __init__(self, send_executor: Executor, generate: Callable, send: Callable, requeue: Callable,
+        max_inflight: int = 0, priority: Callable = None):
+        self.send_executor = send_executor
+        self.generate = generate
+        self.send = send
+        self.requeue = requeue
+        self.max_inflight = max_inflight
+        self.priority = priority
+        self.stages = {}
+        self.generating = 0
+        self._ready = []
+        self._seq = itertools.count()
+        self._again = set()
+        self._lock = threading.Lock()
+
+    def _free(self) -> bool:
+        return self.max_inflight <= 0 or self.generating < self.max_inflight
+
+    def submit(self, uid: str) -> bool:
+        with self._lock:
+            if uid in self.stages:
+                self._again.add(uid)
+                return False
+            start = self._free() and len(self._ready) == 0
+            self.stages[uid] = 'generating' if start else 'ready'
+            if start:
+                self.generating += 1
+        if start:
+            self._start(uid)
+            return True
+        key = 0 if self.priority is None else self.priority(uid)
+        with self._lock:
+            heapq.heappush(self._ready, (key, next(self._seq), uid))
+        # A slot may have been freed while the key was computed.
+        self._next()
+        return True
+
+    def _next(self):
+        while True:
+            with self._lock:
+                if len(self._ready) == 0 or not self._free():
+                    return
+                uid = heapq.heappop(self._ready)[2]
+                self.stages[uid] = 'generating'
+                self.generating += 1
+            self._start(uid)
+
+    def _start(self, uid: str):
+        f = self.generate(uid)
+        f.add_done_callback(lambda f: self._persisted(uid, f))
+
+    def _persisted(self, uid: str, f: Future):
+        status = None
+        try:
+            status = f.result()
+        except Exception:
+            traceback.print_exc()
+        with self._lock:
+            self.generating -= 1
+            self.stages[uid] = 'persisted'
+        self.send_executor.submit(self._sent, uid, status)
+        self._next()
+
+    def _sent(self, uid: str, status):
+        self.stages[uid] = 'sending'
+        try:
+            self.send(uid)
+        except Exception:
+            traceback.print_exc()
+        with self._lock:
+            del self.stages[uid]
+            again = uid in self._again
+            self._again.discard(uid)
+        if again or status == 'Waiting':
+            self.requeue(uid)
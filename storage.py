@@ -0,0 +1,828 @@
+#######################
+# AI Assistant Python Framework
+# Date: 2024-01-25
+#######################
+
+__all__ = ['PIARecord', 'PIAState', 'PIASummary', 'PIAStorage', 'SQLitePool', 'SQLiteStorage', 'MemoryStorage', 'PIAWriter', 'open_storage', 'init_db', 'legacy_tables', 'migrate_tables']
+
+from typing import Callable, Dict, List, NamedTuple, Optional
+from concurrent.futures import Future
+from tokens import message_tokens
+import itertools
+import os
+import queue
+import sqlite3
+import threading
+import time
+import traceback
+
+SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS pia_message (
+        UID TEXT NOT NULL,
+        ID INTEGER NOT NULL,
+        NAME TEXT NOT NULL,
+        TYPE INTEGER NOT NULL DEFAULT 0,
+        TEXT TEXT,
+        CONTENT BLOB,
+        TIME INTEGER NOT NULL,
+        IS_MENTIONED INTEGER NOT NULL,
+        IS_ME INTEGER NOT NULL,
+        IS_AI INTEGER NOT NULL,
+        IS_DELETED INTEGER NOT NULL DEFAULT 0,
+        SENT INTEGER NOT NULL DEFAULT 0,
+        LISTENER TEXT NOT NULL,
+        TOKENS_ALL INTEGER NOT NULL DEFAULT 0,
+        TOKENS_PROMPT INTEGER NOT NULL DEFAULT 0,
+        TOKENS_EST INTEGER NOT NULL DEFAULT 0,
+        BLOB_ID TEXT,
+        PRIMARY KEY (UID, ID)
+    ) WITHOUT ROWID
+    ''',
+    '''
+    CREATE INDEX IF NOT EXISTS pia_message_unsent ON pia_message (UID, ID)
+    WHERE SENT = 0 AND IS_ME = 1 AND IS_DELETED = 0
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS pia_state (
+        UID TEXT PRIMARY KEY,
+        LAST_ID INTEGER NOT NULL DEFAULT 0,
+        LAST_IN_TIME INTEGER NOT NULL DEFAULT 0,
+        LAST_ANSWERED_ID INTEGER NOT NULL DEFAULT 0,
+        PENDING_SEND INTEGER NOT NULL DEFAULT 0,
+        FIRST_IN_TIME INTEGER NOT NULL DEFAULT 0
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS pia_summary (
+        UID TEXT PRIMARY KEY,
+        SUMMARY TEXT NOT NULL,
+        LAST_ID INTEGER NOT NULL,
+        TIME INTEGER NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS pia_cache (
+        KEY TEXT PRIMARY KEY,
+        REPLY TEXT NOT NULL,
+        EXPIRE INTEGER NOT NULL
+    ) WITHOUT ROWID
+    ''',
+    '''
+    CREATE INDEX IF NOT EXISTS pia_cache_expire ON pia_cache (EXPIRE)
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS pia_listener (
+        UID TEXT UNIQUE PRIMARY KEY,
+        UNAME TEXT NOT NULL,
+        LISTENER TEXT NOT NULL
+    )
+    ''',
+]
+
+COLUMNS = 'ID, NAME, TYPE, TEXT, CONTENT, TIME, IS_MENTIONED, IS_ME, IS_AI, IS_DELETED, SENT, LISTENER, TOKENS_ALL, TOKENS_PROMPT'
+
+class PIARecord(NamedTuple):
+    """One stored message, as returned by the storage engines.
+    Binary content is not stored inline: blob is the digest of the content in the PIABlobStore.
+    """
+    id: int
+    name: str
+    type: int
+    text: Optional[str]
+    content: Optional[bytes]
+    time: int
+    is_me: int
+    is_ai: int
+    sent: int = 0
+    listener: str = ''
+    tokens_all: int = 0
+    tokens_prompt: int = 0
+    tokens_est: int = 0
+    blob: Optional[str] = None
+
+class PIAState(NamedTuple):
+    """Per-conversation state, kept in sync with every write.
+    The conversation is answered when last_answered_id >= last_id.
+    first_in_time is the time of the oldest unanswered inbound message (0: none).
+    """
+    uid: str
+    last_id: int = 0
+    last_in_time: int = 0
+    last_answered_id: int = 0
+    pending_send: int = 0
+    first_in_time: int = 0
+
+class PIASummary(NamedTuple):
+    """The summary of the messages of a conversation up to last_id."""
+    uid: str
+    text: str
+    last_id: int
+    time: int
+
+class PIAStorage:
+    """PIA Storage
+    The storage interface used by PIA-Core.
+    Every engine must implement these operations:
+    - append_message: Append a message to a conversation and return its ID.
+    - fetch_recent: Fetch the recent window of a conversation (oldest first),
+      optionally trimmed to a budget of estimated tokens.
+    - fetch_range: Fetch the messages between two IDs (oldest first).
+    - list_unsent: List the replies which have not been sent yet.
+    - mark_sent: Mark a reply as sent.
+    - clear_conversation: Delete all messages of a conversation.
+    - upsert_listener: Bind a conversation to its listener.
+    - get_listener: Get the (UID, UNAME, LISTENER) binding of a conversation.
+    - list_conversations: List the UIDs of all conversations.
+    - get_states: Get the PIAState of several conversations at once.
+    - get_summary/put_summary: Read and replace the PIASummary of a conversation.
+    - get_cached/put_cached/evict_cached: The persistent part of the response cache.
+    - write_batch: Apply several write operations in one transaction.
+    """
+    def append_message(self, uid: str, name: str, text: str, timestamp: int,
+        is_me: int = 0, is_ai: int = 0, listener: str = '', type: int = 0,
+        content: bytes = None, tokens_all: int = 0, tokens_prompt: int = 0, sent: int = 0, blob: str = None) -> int:
+        raise NotImplementedError
+
+    def fetch_recent(self, uid: str, limit: int, budget: int = 0) -> List[PIARecord]:
+        """Fetch the recent window of a conversation
+
+        Args:
+            uid (str): The conversation.
+            limit (int): The maximum number of rows.
+            budget (int, optional): The maximum sum of TOKENS_EST, 0 for no budget.
+                The newest row is always returned. Defaults to 0.
+        """
+        raise NotImplementedError
+
+    def fetch_range(self, uid: str, after_id: int, before_id: int, limit: int) -> List[PIARecord]:
+        raise NotImplementedError
+
+    def list_unsent(self, uid: str) -> List[PIARecord]:
+        raise NotImplementedError
+
+    def mark_sent(self, uid: str, id: int):
+        raise NotImplementedError
+
+    def clear_conversation(self, uid: str):
+        raise NotImplementedError
+
+    def upsert_listener(self, uid: str, uname: str, listener: str):
+        raise NotImplementedError
+
+    def get_listener(self, uid: str) -> Optional[tuple]:
+        raise NotImplementedError
+
+    def list_conversations(self) -> List[str]:
+        raise NotImplementedError
+
+    def get_states(self, uids: List[str]) -> Dict[str, PIAState]:
+        raise NotImplementedError
+
+    def get_state(self, uid: str) -> Optional[PIAState]:
+        return self.get_states([uid]).get(uid)
+
+    def get_summary(self, uid: str) -> Optional[PIASummary]:
+        raise NotImplementedError
+
+    def put_summary(self, uid: str, text: str, last_id: int, timestamp: int):
+        raise NotImplementedError
+
+    def get_cached(self, key: str, now: int) -> Optional[tuple]:
+        """Get the (reply, expire) of a cache key, None if it is absent or expired at now (ms)."""
+        raise NotImplementedError
+
+    def put_cached(self, key: str, reply: str, expire: int):
+        raise NotImplementedError
+
+    def evict_cached(self, now: int, max_entries: int):
+        """Delete the expired entries, then the oldest ones beyond max_entries."""
+        raise NotImplementedError
+
+    def write_batch(self, ops: list):
+        """Apply write operations in one transaction
+
+        Args:
+            ops (list): A list of (method_name, args, kwargs), e.g. ('append_message', (uid, ...), {}).
+        """
+        for name, args, kwargs in ops:
+            getattr(self, name)(*args, **kwargs)
+
+    def close(self):
+        pass
+
+class SQLitePool:
+    """SQLite connection pool
+    Keeps one connection per thread and per process, so the ThreadPoolExecutor
+    workers of main_loop and the listener/module processes never share a handle.
+    Connections inherited through fork() are dropped (not closed) in the child.
+    Every connection runs in WAL mode with synchronous=NORMAL and keeps its own
+    prepared statement cache, so constant SQL strings are only compiled once.
+    """
+    def __init__(self, db_path: str, cache_kb: int = 16384, cached_statements: int = 256):
+        self.db_path = db_path
+        self.cache_kb = cache_kb
+        self.cached_statements = cached_statements
+        self._locals = {}
+
+    def get(self) -> sqlite3.Connection:
+        pid = os.getpid()
+        local = self._locals.get(pid)
+        if local is None:
+            local = self._locals.setdefault(pid, threading.local())
+            local.db = self._open()
+            init_db(local.db)
+        db = getattr(local, 'db', None)
+        if db is None:
+            db = self._open()
+            local.db = db
+        return db
+
+    def _open(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.db_path, timeout = 30, cached_statements = self.cached_statements)
+        db.execute('PRAGMA journal_mode = WAL')
+        db.execute('PRAGMA synchronous = NORMAL')
+        db.execute('PRAGMA cache_size = -{}'.format(int(self.cache_kb)))
+        return db
+
+    def close(self):
+        local = self._locals.get(os.getpid())
+        db = getattr(local, 'db', None)
+        if db is not None:
+            db.close()
+            local.db = None
+
+class SQLiteStorage(PIAStorage):
+    """SQLite storage engine (pia_message/pia_listener tables)."""
+    def __init__(self, db_path: str, cache_kb: int = 16384):
+        self.db_path = db_path
+        self._pool = SQLitePool(db_path, cache_kb)
+        self._batch = threading.local()
+
+    def close(self):
+        self._pool.close()
+
+    def _commit(self, db: sqlite3.Connection):
+        if not getattr(self._batch, 'active', False):
+            db.commit()
+
+    def write_batch(self, ops):
+        db = self._pool.get()
+        self._batch.active = True
+        try:
+            super().write_batch(ops)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            self._batch.active = False
+
+    def append_message(self, uid, name, text, timestamp, is_me = 0, is_ai = 0, listener = '',
+        type = 0, content = None, tokens_all = 0, tokens_prompt = 0, sent = 0, blob = None):
+        db = self._pool.get()
+        cur = db.execute(
+            '''
+            INSERT INTO pia_message (UID, ID, NAME, TYPE, TEXT, CONTENT, TIME, IS_MENTIONED, IS_ME, IS_AI, SENT, LISTENER, TOKENS_ALL, TOKENS_PROMPT, TOKENS_EST, BLOB_ID)
+            VALUES (?, (SELECT IFNULL(MAX(ID), 0) + 1 FROM pia_message WHERE UID = ?), ?, ?, ?, ?, ?, 0, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''',
+            (uid, uid, name, type, text, content, timestamp, is_me, is_ai, sent, listener, tokens_all, tokens_prompt,
+             message_tokens(name, text) if type == 0 or blob else 0, blob)
+        )
+        # The write lock is held until commit, so MAX(ID) is still our row.
+        cur.execute('SELECT MAX(ID) FROM pia_message WHERE UID = ?', (uid,))
+        id = cur.fetchone()[0]
+        cur.execute(
+            '''
+            INSERT INTO pia_state (UID, LAST_ID, LAST_IN_TIME, LAST_ANSWERED_ID, PENDING_SEND, FIRST_IN_TIME)
+            VALUES (:uid, :id, :in_time, :answered_id, :pending, :in_time)
+            ON CONFLICT(UID) DO UPDATE SET
+                LAST_ID = :id,
+                LAST_IN_TIME = CASE WHEN :is_me = 0 THEN :in_time ELSE LAST_IN_TIME END,
+                LAST_ANSWERED_ID = CASE WHEN :is_me = 1 THEN :id ELSE LAST_ANSWERED_ID END,
+                PENDING_SEND = PENDING_SEND + :pending,
+                FIRST_IN_TIME = CASE
+                    WHEN :is_me = 1 THEN 0
+                    WHEN LAST_ANSWERED_ID >= LAST_ID OR FIRST_IN_TIME = 0 THEN :in_time
+                    ELSE FIRST_IN_TIME END
+            ''',
+            {
+                'uid': uid,
+                'id': id,
+                'is_me': 1 if is_me else 0,
+                'in_time': 0 if is_me else timestamp,
+                'answered_id': id if is_me else 0,
+                'pending': 1 if is_me and not sent else 0,
+            }
+        )
+        self._commit(db)
+        return id
+
+    def fetch_recent(self, uid, limit, budget = 0):
+        db = self._pool.get()
+        if budget <= 0:
+            cur = db.execute(
+                '''
+                SELECT ID,NAME,TYPE,TEXT,CONTENT,TIME,IS_ME,IS_AI,SENT,LISTENER,TOKENS_ALL,TOKENS_PROMPT,TOKENS_EST,BLOB_ID FROM
+                pia_message WHERE UID = ? AND IS_DELETED = 0 AND ID >
+                (SELECT MAX(ID) - ? FROM pia_message WHERE UID = ? AND IS_DELETED = 0)
+                ORDER BY ID
+                ''',
+                (uid, limit, uid)
+            )
+        else:
+            # Running total from the newest row backwards, it only grows, so the kept rows stay contiguous.
+            cur = db.execute(
+                '''
+                SELECT ID,NAME,TYPE,TEXT,CONTENT,TIME,IS_ME,IS_AI,SENT,LISTENER,TOKENS_ALL,TOKENS_PROMPT,TOKENS_EST,BLOB_ID FROM (
+                    SELECT *,
+                        SUM(TOKENS_EST) OVER (ORDER BY ID DESC) AS TOTAL,
+                        ROW_NUMBER() OVER (ORDER BY ID DESC) AS N
+                    FROM pia_message WHERE UID = ? AND IS_DELETED = 0 AND ID >
+                    (SELECT MAX(ID) - ? FROM pia_message WHERE UID = ? AND IS_DELETED = 0)
+                ) WHERE TOTAL <= ? OR N = 1
+                ORDER BY ID
+                ''',
+                (uid, limit, uid, budget)
+            )
+        df = [PIARecord(*d) for d in cur.fetchall()]
+        return df
+
+    def fetch_range(self, uid, after_id, before_id, limit):
+        db = self._pool.get()
+        cur = db.execute(
+            '''
+            SELECT ID,NAME,TYPE,TEXT,CONTENT,TIME,IS_ME,IS_AI,SENT,LISTENER,TOKENS_ALL,TOKENS_PROMPT,TOKENS_EST,BLOB_ID FROM
+            pia_message WHERE UID = ? AND ID > ? AND ID < ? AND IS_DELETED = 0
+            ORDER BY ID LIMIT ?
+            ''',
+            (uid, after_id, before_id, limit)
+        )
+        df = [PIARecord(*d) for d in cur.fetchall()]
+        return df
+
+    def list_unsent(self, uid):
+        db = self._pool.get()
+        cur = db.execute(
+            '''
+            SELECT ID,NAME,TYPE,TEXT,CONTENT,TIME,IS_ME,IS_AI,SENT,LISTENER,TOKENS_ALL,TOKENS_PROMPT,TOKENS_EST,BLOB_ID FROM
+            pia_message WHERE UID = ? AND SENT = 0 AND IS_DELETED = 0 AND IS_ME = 1
+            ORDER BY ID
+            ''',
+            (uid,)
+        )
+        df = [PIARecord(*d) for d in cur.fetchall()]
+        return df
+
+    def mark_sent(self, uid, id):
+        db = self._pool.get()
+        cur = db.execute(
+            '''
+            UPDATE pia_message SET SENT = 1 WHERE UID = ? AND ID = ? AND SENT = 0
+            ''',
+            (uid, id)
+        )
+        if cur.rowcount > 0:
+            cur.execute(
+                '''
+                UPDATE pia_state SET PENDING_SEND = MAX(PENDING_SEND - 1, 0) WHERE UID = ?
+                ''',
+                (uid,)
+            )
+        self._commit(db)
+
+    def clear_conversation(self, uid):
+        db = self._pool.get()
+        db.execute(
+            '''
+            UPDATE pia_message SET IS_DELETED = 1 WHERE UID = ?
+            ''',
+            (uid,)
+        )
+        db.execute(
+            '''
+            UPDATE pia_state SET LAST_ANSWERED_ID = LAST_ID, PENDING_SEND = 0, FIRST_IN_TIME = 0 WHERE UID = ?
+            ''',
+            (uid,)
+        )
+        db.execute(
+            '''
+            DELETE FROM pia_summary WHERE UID = ?
+            ''',
+            (uid,)
+        )
+        self._commit(db)
+
+    def upsert_listener(self, uid, uname, listener):
+        db = self._pool.get()
+        db.execute(
+            '''
+            INSERT INTO pia_listener (UID, UNAME, LISTENER) VALUES (?, ?, ?)
+            ON CONFLICT(UID) DO UPDATE SET UNAME = excluded.UNAME, LISTENER = excluded.LISTENER
+            ''',
+            (uid, uname, listener)
+        )
+        self._commit(db)
+
+    def get_listener(self, uid):
+        db = self._pool.get()
+        cur = db.execute(
+            '''
+            SELECT UID,UNAME,LISTENER FROM pia_listener WHERE UID = ?
+            ''',
+            (uid,)
+        )
+        df = cur.fetchone()
+        return df
+
+    def list_conversations(self):
+        db = self._pool.get()
+        cur = db.execute(
+            '''
+            SELECT UID FROM pia_listener
+            '''
+        )
+        df = [i[0] for i in cur.fetchall()]
+        return df
+
+    def get_states(self, uids):
+        db = self._pool.get()
+        states = {}
+        uids = list(uids)
+        for i in range(0, len(uids), 500):
+            part = uids[i:i+500]
+            cur = db.execute(
+                '''
+                SELECT UID,LAST_ID,LAST_IN_TIME,LAST_ANSWERED_ID,PENDING_SEND,FIRST_IN_TIME FROM pia_state
+                WHERE UID IN ({})
+                '''.format(','.join('?' * len(part))),
+                part
+            )
+            for d in cur.fetchall():
+                states[d[0]] = PIAState(*d)
+        return states
+
+    def get_summary(self, uid):
+        db = self._pool.get()
+        cur = db.execute(
+            '''
+            SELECT UID,SUMMARY,LAST_ID,TIME FROM pia_summary WHERE UID = ?
+            ''',
+            (uid,)
+        )
+        df = cur.fetchone()
+        return None if df is None else PIASummary(*df)
+
+    def put_summary(self, uid, text, last_id, timestamp):
+        db = self._pool.get()
+        db.execute(
+            '''
+            INSERT INTO pia_summary (UID, SUMMARY, LAST_ID, TIME) VALUES (?, ?, ?, ?)
+            ON CONFLICT(UID) DO UPDATE SET SUMMARY = excluded.SUMMARY, LAST_ID = excluded.LAST_ID, TIME = excluded.TIME
+            ''',
+            (uid, text, last_id, timestamp)
+        )
+        self._commit(db)
+
+    def get_cached(self, key, now):
+        db = self._pool.get()
+        cur = db.execute(
+            '''
+            SELECT REPLY,EXPIRE FROM pia_cache WHERE KEY = ? AND EXPIRE > ?
+            ''',
+            (key, now)
+        )
+        return cur.fetchone()
+
+    def put_cached(self, key, reply, expire):
+        db = self._pool.get()
+        db.execute(
+            '''
+            INSERT OR REPLACE INTO pia_cache (KEY, REPLY, EXPIRE) VALUES (?, ?, ?)
+            ''',
+            (key, reply, expire)
+        )
+        self._commit(db)
+
+    def evict_cached(self, now, max_entries):
+        db = self._pool.get()
+        db.execute(
+            '''
+            DELETE FROM pia_cache WHERE EXPIRE <= ?
+            ''',
+            (now,)
+        )
+        db.execute(
+            '''
+            DELETE FROM pia_cache WHERE KEY IN (
+                SELECT KEY FROM pia_cache ORDER BY EXPIRE
+                LIMIT MAX((SELECT COUNT(*) FROM pia_cache) - ?, 0)
+            )
+            ''',
+            (max_entries,)
+        )
+        self._commit(db)
+
+class MemoryStorage(PIAStorage):
+    """In-memory storage engine.
+    Only visible inside the current process, use it for tests and benchmarks.
+    It takes no locks: every mutation is a single dict/list operation or a next()
+    on an itertools.count, which are atomic under the GIL.
+    """
+    def __init__(self, *args, **kwargs):
+        self._messages = {}
+        self._ids = {}
+        self._cleared = {}
+        self._unsent = {}
+        self._listeners = {}
+        self._in_time = {}
+        self._answered = {}
+        self._first_in = {}
+        self._summaries = {}
+        self._cache = {}
+
+    def append_message(self, uid, name, text, timestamp, is_me = 0, is_ai = 0, listener = '',
+        type = 0, content = None, tokens_all = 0, tokens_prompt = 0, sent = 0, blob = None):
+        id = next(self._ids.setdefault(uid, itertools.count(1)))
+        rec = PIARecord(id, name, type, text, content, timestamp, is_me, is_ai, sent, listener, tokens_all, tokens_prompt,
+            message_tokens(name, text) if type == 0 or blob else 0, blob)
+        self._messages.setdefault(uid, {})[id] = rec
+        if is_me == 1:
+            if not sent:
+                self._unsent.setdefault(uid, {})[id] = rec
+            self._answered[uid] = id
+            self._first_in.pop(uid, None)
+        else:
+            self._in_time[uid] = timestamp
+            self._first_in.setdefault(uid, timestamp)
+        return id
+
+    def fetch_recent(self, uid, limit, budget = 0):
+        rows = self._messages.get(uid, {})
+        last = len(rows)
+        start = max(self._cleared.get(uid, 0), last - limit)
+        df = [rows[i] for i in range(start + 1, last + 1) if i in rows]
+        if budget > 0:
+            total = 0
+            for n in range(len(df) - 1, -1, -1):
+                total += df[n].tokens_est
+                if total > budget and n < len(df) - 1:
+                    return df[n + 1:]
+        return df
+
+    def fetch_range(self, uid, after_id, before_id, limit):
+        rows = self._messages.get(uid, {})
+        start = max(self._cleared.get(uid, 0), after_id)
+        return [rows[i] for i in range(start + 1, min(before_id, len(rows) + 1)) if i in rows][:limit]
+
+    def list_unsent(self, uid):
+        return list(self._unsent.get(uid, {}).values())
+
+    def mark_sent(self, uid, id):
+        rec = self._unsent.get(uid, {}).pop(id, None)
+        if rec is not None:
+            self._messages[uid][id] = rec._replace(sent = 1)
+
+    def clear_conversation(self, uid):
+        self._cleared[uid] = len(self._messages.get(uid, []))
+        self._answered[uid] = self._cleared[uid]
+        self._unsent[uid] = {}
+        self._first_in.pop(uid, None)
+        self._summaries.pop(uid, None)
+
+    def upsert_listener(self, uid, uname, listener):
+        self._listeners[uid] = (uid, uname, listener)
+
+    def get_listener(self, uid):
+        return self._listeners.get(uid)
+
+    def list_conversations(self):
+        return list(self._listeners.keys())
+
+    def get_states(self, uids):
+        states = {}
+        for uid in uids:
+            if uid in self._messages:
+                states[uid] = PIAState(
+                    uid,
+                    len(self._messages[uid]),
+                    self._in_time.get(uid, 0),
+                    self._answered.get(uid, 0),
+                    len(self._unsent.get(uid, {})),
+                    self._first_in.get(uid, 0)
+                )
+        return states
+
+    def get_summary(self, uid):
+        return self._summaries.get(uid)
+
+    def put_summary(self, uid, text, last_id, timestamp):
+        self._summaries[uid] = PIASummary(uid, text, last_id, timestamp)
+
+    def get_cached(self, key, now):
+        item = self._cache.get(key)
+        if item is None or item[1] <= now:
+            return None
+        return item
+
+    def put_cached(self, key, reply, expire):
+        self._cache[key] = (reply, expire)
+
+    def evict_cached(self, now, max_entries):
+        items = sorted(self._cache.items(), key = lambda i: i[1][1])
+        drop = max(len(items) - max_entries, 0)
+        for n, (key, item) in enumerate(items):
+            if n < drop or item[1] <= now:
+                self._cache.pop(key, None)
+
+class PIAWriter:
+    """Group-commit writer
+    Callers enqueue write operations with submit() and get a Future back.
+    One writer thread per process drains the queue and applies everything queued
+    within flush_window seconds (or flush_size submissions) in a single transaction.
+    The Future resolves to True once the batch is committed, then on_commit is
+    called for every affected UID.
+    """
+    def __init__(self, storage: PIAStorage, flush_window: float = 0.05, flush_size: int = 64,
+        on_commit: Callable = lambda uid: None):
+        self.storage = storage
+        self.flush_window = flush_window
+        self.flush_size = flush_size
+        self.on_commit = on_commit
+        self._queues = {}
+
+    def submit(self, ops: list, uid: str = None) -> Future:
+        """Enqueue write operations
+
+        Args:
+            ops (list): The operations, see PIAStorage.write_batch.
+            uid (str, optional): The conversation to pass to on_commit. Defaults to None.
+
+        Returns:
+            Future: Resolved to True after the operations are committed.
+        """
+        f = Future()
+        if self.flush_window <= 0:
+            self._flush([(ops, uid, f)])
+            return f
+        pid = os.getpid()
+        q = self._queues.get(pid)
+        if q is None:
+            q = queue.Queue()
+            if self._queues.setdefault(pid, q) is q:
+                threading.Thread(target=self._run, args=(q,), daemon=True).start()
+            q = self._queues[pid]
+        q.put((ops, uid, f))
+        return f
+
+    def _run(self, q: queue.Queue):
+        while True:
+            batch = [q.get()]
+            deadline = time.monotonic() + self.flush_window
+            while len(batch) < self.flush_size:
+                remain = deadline - time.monotonic()
+                if remain <= 0:
+                    break
+                try:
+                    batch.append(q.get(timeout=remain))
+                except queue.Empty:
+                    break
+            self._flush(batch)
+
+    def _flush(self, batch: list):
+        try:
+            self.storage.write_batch([op for b in batch for op in b[0]])
+            done = batch
+        except Exception:
+            # Retry one by one, so a bad submission does not fail the whole batch.
+            done = []
+            for b in batch:
+                try:
+                    self.storage.write_batch(b[0])
+                    done.append(b)
+                except Exception as e:
+                    # Nobody may wait on the Future, the failure must not go unnoticed.
+                    traceback.print_exc()
+                    b[2].set_exception(e)
+        for uid in {b[1] for b in done if b[1] is not None}:
+            try:
+                self.on_commit(uid)
+            except Exception:
+                traceback.print_exc()
+        for b in done:
+            b[2].set_result(True)
+
+ENGINES = {
+    'sqlite': SQLiteStorage,
+    'memory': MemoryStorage,
+}
+
+def open_storage(loop_config) -> PIAStorage:
+    """Open the storage engine selected by LoopConfig.storage."""
+    return ENGINES[loop_config.storage](loop_config.db_path, cache_kb = loop_config.db_cache_kb)
+
+def init_db(db: sqlite3.Connection):
+    """Create the message tables if they do not exist.
+    All conversations share pia_message, clustered by (UID, ID).
+    Message IDs are allocated per conversation, so they stay contiguous inside one UID.
+    pia_state is rebuilt from pia_message when it is created.
+    """
+    cur = db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='pia_state'")
+    has_state = cur.fetchone() is not None
+    for sql in SCHEMA:
+        db.execute(sql)
+    if not has_state:
+        rebuild_state(db)
+    if 'FIRST_IN_TIME' not in [d[1] for d in db.execute('PRAGMA table_info(pia_state)').fetchall()]:
+        db.execute('ALTER TABLE pia_state ADD COLUMN FIRST_IN_TIME INTEGER NOT NULL DEFAULT 0')
+        rebuild_state(db)
+    columns = [d[1] for d in db.execute('PRAGMA table_info(pia_message)').fetchall()]
+    if 'TOKENS_EST' not in columns:
+        db.execute('ALTER TABLE pia_message ADD COLUMN TOKENS_EST INTEGER NOT NULL DEFAULT 0')
+        estimate_rows(db)
+    if 'BLOB_ID' not in columns:
+        db.execute('ALTER TABLE pia_message ADD COLUMN BLOB_ID TEXT')
+    db.commit()
+
+def rebuild_state(db: sqlite3.Connection):
+    db.execute(
+        '''
+        INSERT OR REPLACE INTO pia_state (UID, LAST_ID, LAST_IN_TIME, LAST_ANSWERED_ID, PENDING_SEND, FIRST_IN_TIME)
+        SELECT UID, MAX(ID),
+            IFNULL((SELECT TIME FROM pia_message i WHERE i.UID = m.UID AND i.IS_ME = 0 ORDER BY ID DESC LIMIT 1), 0),
+            IFNULL(MAX(CASE WHEN IS_ME = 1 OR IS_DELETED = 1 THEN ID END), 0),
+            SUM(CASE WHEN IS_ME = 1 AND SENT = 0 AND IS_DELETED = 0 THEN 1 ELSE 0 END),
+            IFNULL((SELECT MIN(TIME) FROM pia_message i WHERE i.UID = m.UID AND i.IS_ME = 0 AND i.IS_DELETED = 0 AND i.ID >
+                IFNULL((SELECT MAX(ID) FROM pia_message j WHERE j.UID = m.UID AND (j.IS_ME = 1 OR j.IS_DELETED = 1)), 0)), 0)
+        FROM pia_message m GROUP BY UID
+        '''
+    )
+
+def estimate_rows(db: sqlite3.Connection):
+    """Fill TOKENS_EST of the text rows which do not have an estimate yet."""
+    while True:
+        # Estimates are never 0 (MESSAGE_OVERHEAD), so updated rows leave the selection.
+        cur = db.execute(
+            '''
+            SELECT UID,ID,NAME,TEXT FROM pia_message WHERE TOKENS_EST = 0 AND TYPE = 0 LIMIT 1000
+            '''
+        )
+        rows = cur.fetchall()
+        if len(rows) == 0:
+            break
+        db.executemany(
+            '''
+            UPDATE pia_message SET TOKENS_EST = ? WHERE UID = ? AND ID = ?
+            ''',
+            [(message_tokens(d[2], d[3]), d[0], d[1]) for d in rows]
+        )
+
+def legacy_tables(db: sqlite3.Connection) -> list:
+    """The names of the legacy chat_<uid> tables."""
+    cur = db.execute(
+        '''
+        SELECT name FROM sqlite_master WHERE type='table' AND name LIKE 'chat\\_%' ESCAPE '\\'
+        '''
+    )
+    return [i[0] for i in cur.fetchall()]
+
+def migrate_tables(db_path: str) -> int:
+    """Import legacy chat_<uid> tables into pia_message.
+    Every table is copied and dropped in its own transaction, so the migration can be resumed.
+    If the conversation already has rows in pia_message (PIA ran before the migration),
+    they are renumbered after the legacy history, which keeps its IDs.
+    A table is only dropped once all of its rows were copied.
+
+    Args:
+        db_path (str): The database path.
+
+    Returns:
+        int: The number of migrated tables.
+    """
+    db = sqlite3.connect(db_path)
+    init_db(db)
+    tables = legacy_tables(db)
+    for t in tables:
+        uid = t[5:]
+        with db:
+            last = db.execute('SELECT MAX(ID) FROM {}'.format(t)).fetchone()[0]
+            first = db.execute('SELECT MIN(ID) FROM pia_message WHERE UID = ?', (uid,)).fetchone()[0]
+            if last is not None and first is not None and first <= last:
+                # Negative first, so no row collides with another while it moves.
+                db.execute('UPDATE pia_message SET ID = -(ID + ?) WHERE UID = ?', (last - first + 1, uid))
+                db.execute('UPDATE pia_message SET ID = -ID WHERE UID = ? AND ID < 0', (uid,))
+                # The summary refers to the old IDs, it is made again by the compactor.
+                db.execute('DELETE FROM pia_summary WHERE UID = ?', (uid,))
+            # A conflict raises and rolls back, the table is kept.
+            db.execute(
+                '''
+                INSERT INTO pia_message (UID, {0}) SELECT ?, {0} FROM {1}
+                '''.format(COLUMNS, t),
+                (uid,)
+            )
+            db.execute('DROP TABLE {}'.format(t))
+    with db:
+        rebuild_state(db)
+        estimate_rows(db)
+    db.close()
+    return len(tables)
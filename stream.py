@@ -0,0 +1,123 @@
+#######################
+# AI Assistant Python Framework
+# Date: 2024-01-25
+#######################
+
+__all__ = ['PIAObject', 'PIAStreamCollector', 'PIAStreamSink']
+
+from classes import PIAListener, PIAResponse, PIAResponseMessage
+from typing import Callable
+import time
+
+class PIAObject(dict):
+    """A dict with attribute access.
+    Used to rebuild completions from stream chunks: main_complete reads them like
+    the SDK objects, and they are sent back to the API as plain message dicts.
+    """
+    __getattr__ = dict.get
+
+class PIAStreamCollector:
+    """PIA Stream Collector
+    Accumulates chat completion chunks into one completion-like PIAObject.
+    Content is pushed in pieces of at least chunk_size characters (or at a newline),
+    tool call fragments are joined by their index.
+    """
+    def __init__(self, push: Callable, chunk_size: int = 32):
+        self.push = push
+        self.chunk_size = chunk_size
+        self.text = ''
+        self.buf = ''
+        self.tool_calls = {}
+        self.usage = None
+
+    def feed(self, chunk):
+        if getattr(chunk, 'usage', None):
+            self.usage = chunk.usage
+        if not chunk.choices:
+            return
+        delta = chunk.choices[0].delta
+        if delta.content:
+            self.text += delta.content
+            self.buf += delta.content
+            if len(self.buf) >= self.chunk_size or '\n' in self.buf:
+                self.push(self.buf)
+                self.buf = ''
+        for tc in delta.tool_calls or []:
+            t = self.tool_calls.setdefault(tc.index, {'id': '', 'name': '', 'arguments': ''})
+            if tc.id:
+                t['id'] = tc.id
+            if tc.function and tc.function.name:
+                t['name'] += tc.function.name
+            if tc.function and tc.function.arguments:
+                t['arguments'] += tc.function.arguments
+
+    def result(self) -> PIAObject:
+        if self.buf:
+            self.push(self.buf)
+            self.buf = ''
+        message = PIAObject(role = 'assistant', content = self.text or None)
+        if len(self.tool_calls) > 0:
+            message['tool_calls'] = [
+                PIAObject(
+                    id = t['id'],
+                    type = 'function',
+                    function = PIAObject(name = t['name'], arguments = t['arguments'])
+                ) for _, t in sorted(self.tool_calls.items())
+            ]
+        usage = PIAObject(
+            total_tokens = self.usage.total_tokens if self.usage else 0,
+            prompt_tokens = self.usage.prompt_tokens if self.usage else 0
+        )
+        return PIAObject(choices = [PIAObject(message = message)], usage = usage)
+
+class PIAStreamSink:
+    """PIA Stream Sink
+    Delivers text pieces of one reply to the streamer of a listener.
+    The listener gets PIAResponse chunks with final=False, then an empty PIAResponse with final=True.
+    Once the streamer returns False the rest of the reply is not streamed, delivered
+    stays False and the reply is left to main_send.
+    """
+    def __init__(self, listener: PIAListener, t_uid: str, t_uname: str, strip: Callable = lambda s: s):
+        self.listener = listener
+        self.t_uid = t_uid
+        self.t_uname = t_uname
+        self.strip = strip
+        self.started = False
+        self.failed = False
+
+    @property
+    def delivered(self) -> bool:
+        return self.started and not self.failed
+
+    def push(self, text: str):
+        if self.failed:
+            return
+        if not self.started:
+            text = self.strip(text)
+            if len(text) == 0:
+                return
+        self.started = True
+        st = self.listener.i_streamer(PIAResponse(
+            t_uid = self.t_uid,
+            t_uname = self.t_uname,
+            messages = [
+                PIAResponseMessage(
+                    type=0,
+                    uname='ME',
+                    text=text,
+                    timestamp=int(time.time()*1000)
+                )
+            ]
+        ), False)
+        if not st:
+            self.failed = True
+
+    def close(self):
+        if self.started:
+            st = self.listener.i_streamer(PIAResponse(
+                t_uid = self.t_uid,
+                t_uname = self.t_uname,
+                messages = []
+            ), True)
+            if not st:
+                self.failed = True
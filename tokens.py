@@ -0,0 +1,36 @@
+#######################
+# AI Assistant Python Framework
+# Date: 2024-01-25
+#######################
+
+__all__ = ['estimate_tokens', 'message_tokens']
+
+import re
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding('cl100k_base')
+except Exception:
+    # tiktoken is optional, fall back to the heuristic below.
+    _encoding = None
+
+# CJK characters are about one token each, other text about four characters per token.
+_CJK = re.compile(r'[\u3000-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]')
+
+# Rendered name, timestamp and separators of one transcript line, see PIAContextBuilder.
+MESSAGE_OVERHEAD = 16
+
+def estimate_tokens(text: str) -> int:
+    """Estimate the number of tokens of a text.
+    Uses tiktoken (cl100k_base) when it is installed, else a character heuristic.
+    """
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special = ()))
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+def message_tokens(name: str, text: str) -> int:
+    """Estimate the prompt tokens of one stored message, as rendered in the transcript."""
+    return estimate_tokens(name) + estimate_tokens(text) + MESSAGE_OVERHEAD